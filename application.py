@@ -2,16 +2,20 @@
 Contributers: Zoe Takacs and Wyatt Shaw
 Info: Main application and screen classes
 '''
+import os
 import sys
 import logging
 import numpy as np
 
 from PyQt5.uic import loadUi
-from PyQt5.QtWidgets import QApplication, QMainWindow, QDialog, QStackedWidget, QMessageBox
-from PyQt5.QtGui import QPixmap
-from PyQt5.QtCore import Qt
+from PyQt5.QtWidgets import QApplication, QMainWindow, QDialog, QStackedWidget, QMessageBox, QProgressDialog, QAction
+from PyQt5.QtGui import QPixmap, QImage, QKeySequence
+from PyQt5.QtCore import Qt, QTimer, pyqtSignal
 
+from base_classes import Camera
 from controller_classes import SessionController, UserController
+from metrics import REGISTRY
+from profiling import PROFILER, StallMonitor
 from random import shuffle
 from stylesheet import Light, Sunset, Dark
 
@@ -32,6 +36,8 @@ class MainWindow(QMainWindow):
         _mainmenu_scn (MainMenu): initializes the main menu page
         _lesson1_scn (Lesson1): initializes the first lesson page
         _stacked_widget (QStackedWidget): stores the applicatin pages
+        _stall_monitor (StallMonitor): measures event loop stalls while profiling
+        _heartbeat (QTimer): ticks the stall monitor and ends the profiling window, only runs while profiling
     '''
     def __init__(self):
         super().__init__()
@@ -42,9 +48,11 @@ class MainWindow(QMainWindow):
 
         self._current_user = None
 
-        # initialize base class controllers
-        self._session_controller = SessionController('Zoya_Letters_EP10.pkl')
-        self._user_controller = UserController('user_database')
+        # initialize base class controllers, the model loads in the background while the login page is up
+        # the camera captures on its own thread so taking a picture is a memory read of a fresh frame
+        self._session_controller = SessionController('Zoya_Letters_EP10.pkl', load_async=True, camera=Camera(threaded=True))
+        # profiles are saved from a background thread so finishing a lesson never waits on the disk
+        self._user_controller = UserController('user_database', backend='sqlite', write_behind=True)
 
         # initialize all application screens
         self._login_scn = LoginPage(self)
@@ -59,6 +67,24 @@ class MainWindow(QMainWindow):
         self.setCentralWidget(self._stacked_widget)
         
         self._stacked_widget.setCurrentWidget(self._login_scn)
+
+        # stage timings are served locally when METRICS_PORT is set, e.g. curl http://127.0.0.1:9100/metrics
+        if os.getenv("METRICS_PORT"):
+            host, port = REGISTRY.serve(int(os.getenv("METRICS_PORT")))
+            logger.info(f"Serving metrics on http://{host}:{port}/metrics")
+
+        # profiling for operators: PROFILE=lesson or PROFILE=<captures>, or the hidden Ctrl+Shift+P action
+        self._stall_monitor = StallMonitor(interval=0.05, on_stall=PROFILER.record_stall)
+        self._heartbeat = QTimer(self)
+        self._heartbeat.setTimerType(Qt.PreciseTimer)
+        self._heartbeat.timeout.connect(self.profiling_heartbeat)
+        profile_action = QAction("Profile", self)
+        profile_action.setShortcut(QKeySequence("Ctrl+Shift+P"))
+        profile_action.triggered.connect(self.toggle_profiling)
+        # added to the window only, so it has a shortcut but no visible menu entry
+        self.addAction(profile_action)
+        if os.getenv("PROFILE"):
+            self.toggle_profiling()
     
     def set_style(self, style):
         logger.info(f"Changed theme to: {style}")
@@ -75,10 +101,54 @@ class MainWindow(QMainWindow):
         self._mainmenu_scn.setStyleSheet(new_theme)
         self._lesson1_scn.setStyleSheet(new_theme)
 
+    def toggle_profiling(self):
+        # arms the window given by PROFILE (the next lesson by default), or ends a running one early
+        if PROFILER.state != 'idle':
+            self.profiling_finished(PROFILER.stop())
+            return
+        try:
+            mode = PROFILER.parse_mode(os.getenv("PROFILE", "lesson"))
+        except ValueError as e:
+            logger.info(f"Profiling not started: {e}")
+            return
+        PROFILER.arm(mode)
+        logger.info(f"Profiling {'the next lesson' if mode == 'lesson' else f'the next {mode} captures'}")
+        self._stall_monitor.reset()
+        self._heartbeat.start(int(self._stall_monitor.interval * 1000))
+
+    def profiling_heartbeat(self):
+        self._stall_monitor.tick()
+        paths = PROFILER.poll()
+        if paths != None:
+            self.profiling_finished(paths)
+
+    def profiling_finished(self, paths):
+        self._heartbeat.stop()
+        if paths == None:
+            logger.info("Profiling cancelled")
+            return
+        logger.info(f"Profile written to {paths['profile']}, {paths['collapsed']} and {paths['summary']}")
+        QMessageBox(QMessageBox.NoIcon, "Profiling", f"Profile written to {os.path.dirname(os.path.abspath(paths['profile']))}",
+                    QMessageBox.Ok, self).show()
+
     def switch_to_screen(self, screen):
         # change page that is visible
         self._stacked_widget.setCurrentWidget(screen)
 
+    def closeEvent(self, event):
+        # keep a window that is still running
+        if PROFILER.state in ('running', 'finishing'):
+            self.profiling_finished(PROFILER.stop())
+        # stop the inference worker so a pending capture does not keep the process alive
+        self._session_controller.shutdown()
+        # make sure the latest lesson results are on disk
+        self._user_controller.close(timeout=5)
+        # keep the stage timings of this session when METRICS_FILE is set
+        if os.getenv("METRICS_FILE"):
+            REGISTRY.dump_json(os.getenv("METRICS_FILE"))
+        REGISTRY.stop_serving()
+        super().closeEvent(event)
+
 
 class LoginPage(QMainWindow):
     '''Functionalities of LoginPage:
@@ -119,7 +189,7 @@ class LoginPage(QMainWindow):
         name = self.loginusernameEdit.text()
 
         # ensure user exists in database
-        if name in self.parent._user_controller._active_users:
+        if self.parent._user_controller.user_exists(name):
             self.parent._current_user = name
             logger.info(f"Logged in as: {name}")
             self.parent.switch_to_screen(self.parent._mainmenu_scn)
@@ -131,11 +201,19 @@ class MainMenu(QDialog):
     '''Functionalities of MainMenu:
     - Have user choose what lesson they want to try
     - For now only one lesson available
+    - Wait for the model to finish loading before starting a lesson
+
+    Signals:
+    model_ready: emitted from the inference worker once the model has loaded, delivered on the GUI thread
     '''
+    model_ready = pyqtSignal()
+
     def __init__(self, parent):
         super().__init__()
         self.parent = parent
+        self._progress = None
         loadUi("mainmenuGUI.ui", self)
+        self.model_ready.connect(self.start_lesson_1, Qt.QueuedConnection)
         self.logoutButton.clicked.connect(self.logout)
         self.checkscoreButton.clicked.connect(self.check_score)
         self.setmodeButton.clicked.connect(self.change_theme)
@@ -148,6 +226,24 @@ class MainMenu(QDialog):
 
     def choose_lesson_1(self):
         logger.info("Lesson 1 selected.")
+        state, elapsed = self.parent._session_controller.load_status()
+        if state != 'loading':
+            self.start_lesson_1()
+        elif self._progress == None:
+            # only show progress when the model is still loading
+            logger.info(f"Waiting for model, loading for {elapsed:.1f}s")
+            self._progress = QProgressDialog("Loading the sign language model...", None, 0, 0, self)
+            self._progress.setWindowTitle("Please wait")
+            self._progress.setWindowModality(Qt.WindowModal)
+            self._progress.show()
+            self.parent._session_controller.on_ready(self.model_ready.emit)
+
+    def start_lesson_1(self):
+        if self._progress != None:
+            self._progress.close()
+            self._progress = None
+        # starts a profiling window armed for the next lesson
+        PROFILER.lesson_started()
         self.parent.switch_to_screen(self.parent._lesson1_scn)
     
     def update_user_info(self):
@@ -155,12 +251,14 @@ class MainMenu(QDialog):
             # update user info on settings page upon login/signup
             self.usernameLabel.setText(self.parent._current_user)
             
-            score = str(round(self.parent._user_controller._active_users[self.parent._current_user]._overall_score, 2))
+            # consistent snapshot, a lesson being saved in the background cannot change it halfway
+            user = self.parent._user_controller.snapshot(self.parent._current_user)
+            score = str(round(user._overall_score, 2))
             logger.info("Found the score.")
             self.scoreLabel.setText(f"{score}%")
             logger.info("Updated the score.")
 
-            proficiency = self.parent._user_controller._active_users[self.parent._current_user]._proficiency
+            proficiency = user._proficiency
             logger.info("Found the proficiency.")
             self.proficiencyLabel.setText(proficiency)
             logger.info("Updated the proficiency.")
@@ -179,7 +277,7 @@ class MainMenu(QDialog):
         # fetch the score of the selected letter
         letter = self.letterselectComboBox.currentText()
         index = ord(letter) - ord('a')
-        result = self.parent._user_controller._active_users[self.parent._current_user]._p_let_scores[index]
+        result = self.parent._user_controller.snapshot(self.parent._current_user)._p_let_scores[index]
         self.letterscoreProgressBar.setValue(int(result))
         logger.info(f'Score {letter} = {result}')
     
@@ -192,11 +290,30 @@ class Lesson1(QDialog):
     '''Functionalities of Lesson1:
     - Cycle through letters of the alphabet randomly
     - Check that user is doing it correctly and save their score
+
+    - Live mode: recognize the sign continuously and accept it once it is held steady
+
+    Signals:
+    prediction_done: emitted from the inference worker with the finished future, delivered on the GUI thread
+    live_result: emitted from the live recognition worker with (letter, agreement, accepted)
+    live_frame: emitted from the live feed thread with every new camera frame, delivered on the GUI thread
     '''
+    prediction_done = pyqtSignal(object)
+    live_result = pyqtSignal(object, float, bool)
+    live_frame = pyqtSignal(object)
+
     def __init__(self, parent):
         super().__init__()
         self.parent = parent
         loadUi("lessonGUI.ui", self)
+        self._pending = None
+        # whether live mode is waiting for the prompted letter, frames and results are ignored otherwise
+        self._live_active = False
+        # always queued, so the handler runs after check_image has stored the pending future
+        self.prediction_done.connect(self.show_prediction, Qt.QueuedConnection)
+        self.live_result.connect(self.show_live_result, Qt.QueuedConnection)
+        self.live_frame.connect(self.show_live_frame, Qt.QueuedConnection)
+        self.liveButton.toggled.connect(self.toggle_live)
         self.retakeButton.hide()
         self.retakeButton.clicked.connect(self.take_image)
         self.reset_lesson()
@@ -231,32 +348,96 @@ class Lesson1(QDialog):
             self.display_score()
     
     def take_image(self):
+        # also used by Retake, which cancels a prediction that is still running
+        self.cancel_prediction()
         try:
             self.button.clicked.disconnect()
         except TypeError:
             pass
+        self.button.setEnabled(True)
         self.button.setText("Take Picture")
         self.button.clicked.connect(self.check_image)
         self.retakeButton.hide()
+        if self.liveButton.isChecked():
+            # live mode captures on its own, the snapshot button is not needed
+            self.button.hide()
+            self.parent._session_controller.reset_live()
+            self._live_active = True
+        else:
+            self.button.show()
+
+    def toggle_live(self, checked):
+        self.cancel_prediction()
+        if checked:
+            # frames are read and recognized off the GUI thread, and live mode does not wait for the model
+            if not self.parent._session_controller.start_live(self.live_result.emit, on_frame=self.live_frame.emit):
+                QMessageBox(QMessageBox.NoIcon, "Error!", "Model not loaded, live mode is not available!     ", QMessageBox.Ok).exec_()
+                self.liveButton.setChecked(False)
+                return
+        else:
+            self._live_active = False
+            self.parent._session_controller.stop_live()
+        self.take_image()
+
+    def show_live_frame(self, frame):
+        # preview every frame, the controller forwards a subsample of them to the model
+        if self._live_active:
+            self.show_frame(frame)
+
+    def show_live_result(self, letter, agreement, accepted):
+        if not self._live_active:
+            return
+        if accepted:
+            self._live_active = False
+            self.button.show()
+            self.result(letter)
+        else:
+            self.questionBox.setText(f"Seeing {letter} ({agreement:.0%}), hold the sign steady")
+
+    def cancel_prediction(self):
+        if self._pending != None:
+            self.parent._session_controller.cancel_capture()
+            self._pending = None
 
     def check_image(self):
         try:
             self.button.clicked.disconnect()
         except TypeError:
             pass
+        # capture and predict on the worker thread, show_prediction picks up the result
+        self.button.setText("Checking...")
+        self.button.setEnabled(False)
+        self.retakeButton.show()
+        self._pending = self.parent._session_controller.capture_and_predict_async(self.prediction_done.emit)
+
+    def show_prediction(self, future):
+        # ignore results of a request the user has already retaken
+        if future is not self._pending:
+            return
+        self._pending = None
         try:
             # get letter prediction
-            letter, _ = self.parent._session_controller.capture_and_predict()
+            letter, _, frame = future.result()
         except:
             QMessageBox(QMessageBox.NoIcon, "Error!", "Camera not accessible!     ", QMessageBox.Ok).exec_()
             self.take_image()
-        self._pixmap.load('new_image.png')
-        self.image.setPixmap(self._pixmap)
-        self.image.update()
+            return
+        self.show_frame(frame)
+        self.button.setEnabled(True)
         self.button.setText("Submit")
         self.button.clicked.connect(lambda: self.result(letter))
         self.retakeButton.show()
 
+    def show_frame(self, frame):
+        # display an in-memory RGB frame without going through an image file
+        if frame is None:
+            return
+        h, w, ch = frame.shape
+        qimg = QImage(frame.data, w, h, ch * w, QImage.Format_RGB888)
+        self._pixmap = QPixmap.fromImage(qimg)
+        self.image.setPixmap(self._pixmap)
+        self.image.update()
+
     def result(self, letter):
         self.retakeButton.hide()
         try:
@@ -283,11 +464,13 @@ class Lesson1(QDialog):
         self.questionBox.setText("Lesson complete!")
         self.promptBox.setText(f"Final score: {np.sum(self._score)}/5")
         self.parent._user_controller.update_user(self.parent._current_user, self._score)
+        PROFILER.lesson_done()
         self.button.setText("Finish")
         self.button.clicked.connect(self.return_to_choose_lesson)
     
     def return_to_choose_lesson(self):
         self.parent.switch_to_screen(self.parent._mainmenu_scn)
+        self.liveButton.setChecked(False)
         self.reset_lesson()
         logger.info("Lesson 1 completed.")
         
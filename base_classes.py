@@ -1,15 +1,51 @@
 '''File name: base_classes.py
 Contributers: Zoe Takacs and Wyatt Shaw
-Info: Model, User, and Camera class definition
+Info: Model, Camera and frame source class definitions, User is defined in user_profile.py
 '''
-from fastai.vision.all import *
-import cv2
+from abc import ABC, abstractmethod
+from itertools import islice
+from pathlib import Path
+from PIL import Image
+import numpy as np
+import copy
+import io
+import json
 import platform
+import threading
+import time
 
-# proficiency levels in points
-MIN_LEVEL = 35.0
-MED_LEVEL = 60.0
-MAX_LEVEL = 85.0
+from metrics import count, span
+# User lives with the storage layer, re-exported here where it has always been imported from
+from user_profile import MIN_LEVEL, MED_LEVEL, MAX_LEVEL, User
+
+# heavy dependencies are only imported once a Model or Camera is constructed, so launching the
+# login screen or running the database tools does not pull in torch, fastai, matplotlib, pandas...
+torch = None
+nn = None
+fv = None
+cv2 = None
+
+def _import_torch():
+    global torch, nn
+    if torch == None:
+        import torch as _torch
+        torch, nn = _torch, _torch.nn
+
+def _import_fastai():
+    global fv
+    _import_torch()
+    if fv == None:
+        import fastai.vision.all as _fv
+        fv = _fv
+
+def _import_cv2():
+    global cv2
+    if cv2 == None:
+        import cv2 as _cv2
+        cv2 = _cv2
+
+# image files picked up when predicting or calibrating on a directory
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp')
 
 # Path the file path classification when running on Windows, default is Linux
 if platform.system() == 'Windows':
@@ -21,114 +57,716 @@ class Model:
     '''Functionalities of the Model class: 
         - load the model 
         - make predictions on single images
+        - make batched predictions on lists, iterators or directories of images
+        - export the network to TorchScript or ONNX and run inference through that runtime
+        - quantize the network to INT8 and run inference on the quantized TorchScript artifact
 
     Attributes: 
         _loaded_model: holds the model prediction weights and neural network algorithm
+        _backend (string): 'fastai', 'torchscript', 'onnx' or 'int8'
+        _fast_path (bool): skip Learner.predict and run the bare network with a single fused preprocess
+        _net: bare network followed by the loss activation (fast path, torchscript and int8 backends)
+        _session: onnxruntime inference session (onnx backend only)
+        _mean, _std (ndarray): normalization stats extracted from the learner, None if the learner does not normalize
+        _size (tuple): height and width the network input is resized to, read from the Resize of the learner
+        _vocab: letters in the order of the network outputs
     '''
-    def __init__(self, model_fpath):
+    BACKENDS = ('fastai', 'torchscript', 'onnx', 'int8')
+
+    def __init__(self, model_fpath, fast_path=False, backend='fastai', calibration_dir=None):
+        if backend not in self.BACKENDS:
+            raise ValueError(f"Unknown model backend {backend}, expected one of {self.BACKENDS}")
+        self._backend = backend
+        self._fast_path = False
         try:
-            self._loaded_model = load_learner(model_fpath)
+            if backend == 'fastai':
+                _import_fastai()
+                self._loaded_model = fv.load_learner(model_fpath)
+                if fast_path:
+                    self._prepare_fast_path()
+            else:
+                # exported backends always run the bare network, onnx does not even need torch
+                if backend != 'onnx':
+                    _import_torch()
+                self._load_exported(model_fpath, calibration_dir)
         except Exception as e:
             print(f"Error! Model could not be loaded. Error {e}")
             print(model_fpath)
+
+    def is_loaded(self):
+        # loading errors are reported but not raised, so check what was actually set up
+        return getattr(self, '_loaded_model', None) != None or self._fast_path
+
+    @staticmethod
+    def export_paths(model_fpath, backend):
+        # exported artifacts are cached next to the learner pickle
+        model_fpath = Path(model_fpath)
+        suffix = {'torchscript': '.torchscript.pt', 'int8': '.int8.pt'}.get(backend, f'.{backend}')
+        return model_fpath.with_suffix(suffix), model_fpath.with_suffix('.meta.json')
+
+    def _prepare_fast_path(self):
+        # extract everything Learner.predict would look up on every call, once
+        learn = self._loaded_model
+        norm = next((t for t in learn.dls.after_batch.fs if isinstance(t, fv.Normalize)), None)
+        self._mean = norm.mean.cpu().numpy() if norm is not None else None
+        self._std = norm.std.cpu().numpy() if norm is not None else None
+        self._vocab = list(learn.dls.vocab)
+        resize = next((t for t in learn.dls.after_item.fs if isinstance(t, fv.Resize)), None)
+        self._size = tuple(int(side) for side in resize.size) if resize is not None else (192, 192)
+        if self._size != (192, 192):
+            # make_prediction resizes to 192x192 before the learner resizes again, a single resize would not match it
+            raise ValueError(f"Fast path expects the learner to resize to 192x192, not {self._size}")
+        activation = getattr(learn.loss_func, 'activation', fv.noop)
+        self._net = nn.Sequential(learn.model.cpu(), fv.Lambda(activation)).eval()
+        self._fast_path = True
+
+    def export(self, model_fpath, backend):
+        '''Exports the loaded learner for the torchscript or onnx backend
+
+        Args:
+            model_fpath (string): path of the learner pickle, the artifacts are written next to it
+            backend (string): 'torchscript' or 'onnx'
+        '''
+        if not self._fast_path:
+            self._prepare_fast_path()
+        artifact, meta = self.export_paths(model_fpath, backend)
+        example = torch.zeros(1, 3, *self._size)
+        with torch.no_grad():
+            if backend == 'torchscript':
+                traced = torch.jit.freeze(torch.jit.trace(self._net, example))
+                traced.save(str(artifact))
+            elif backend == 'onnx':
+                torch.onnx.export(self._net, example, str(artifact), input_names=['image'], output_names=['probability'],
+                                  dynamic_axes={'image': {0: 'batch'}, 'probability': {0: 'batch'}})
+            else:
+                raise ValueError(f"Cannot export to backend {backend}")
+        self._write_meta(meta)
+
+    def _write_meta(self, meta):
+        # vocab and normalization stats needed to run an exported network without the learner
+        with open(meta, "w") as f:
+            json.dump({'vocab': self._vocab,
+                       'mean': self._mean.tolist() if self._mean is not None else None,
+                       'std': self._std.tolist() if self._std is not None else None,
+                       'size': list(self._size)}, f, indent=4)
+
+    def _load_exported(self, model_fpath, calibration_dir=None):
+        artifact, meta = self.export_paths(model_fpath, self._backend)
+        # (re)export when there is no artifact yet or the learner pickle has been retrained since
+        stale = not artifact.exists() or not meta.exists() or (
+            Path(model_fpath).exists() and artifact.stat().st_mtime < Path(model_fpath).stat().st_mtime)
+        if stale:
+            _import_fastai()
+        if stale and self._backend == 'int8':
+            if calibration_dir is None:
+                raise FileNotFoundError(f"No quantized model at {artifact}, a calibration_dir is needed to create it")
+            self._loaded_model = fv.load_learner(model_fpath)
+            self.quantize(model_fpath, calibration_dir)
+        elif stale:
+            self._loaded_model = fv.load_learner(model_fpath)
+            self.export(model_fpath, self._backend)
+        with open(meta, "r") as f:
+            stats = json.load(f)
+        self._vocab = stats['vocab']
+        self._mean = np.array(stats['mean'], dtype=np.float32) if stats['mean'] is not None else None
+        self._std = np.array(stats['std'], dtype=np.float32) if stats['std'] is not None else None
+        # artifacts exported before the size was recorded were all traced at 192x192
+        self._size = tuple(stats.get('size', (192, 192)))
+        if self._backend == 'int8':
+            torch.backends.quantized.engine = self._quantized_engine()
+        if self._backend in ('torchscript', 'int8'):
+            self._net = torch.jit.load(str(artifact), map_location='cpu')
+        else:
+            import onnxruntime
+            self._session = onnxruntime.InferenceSession(str(artifact), providers=['CPUExecutionProvider'])
+        self._fast_path = True
+
+    @staticmethod
+    def _quantized_engine():
+        # qnnpack kernels for ARM boxes, x86 kernels everywhere else
+        return 'qnnpack' if platform.machine().lower() in ('arm64', 'aarch64') else 'x86'
+
+    @staticmethod
+    def labeled_images(directory):
+        # images in the create_photos.py layout: <letter>/<letter>N.jpg
+        return [(path, letter_dir.name) for letter_dir in sorted(Path(directory).iterdir())
+                if letter_dir.is_dir() and len(letter_dir.name) == 1
+                for path in sorted(letter_dir.iterdir()) if path.suffix.lower() in IMAGE_EXTENSIONS]
+
+    def _evaluate(self, net, samples, batch_size=32):
+        # accuracy and per-image latency of a network over labeled samples
+        predictions, start = [], time.perf_counter()
+        with torch.no_grad():
+            for i in range(0, len(samples), batch_size):
+                x = torch.from_numpy(self._preprocess([path for path, _ in samples[i:i + batch_size]]))
+                predictions += [self._vocab[int(row.argmax())] for row in net(x)]
+        elapsed = time.perf_counter() - start
+        correct = sum(pred.lower() == label.lower() for pred, (_, label) in zip(predictions, samples))
+        return predictions, correct / max(len(samples), 1), 1000 * elapsed / max(len(samples), 1)
+
+    @staticmethod
+    def split_calibration(samples, max_calibration):
+        '''Splits labeled images into calibration and evaluation images
+
+        Calibration images are taken round robin from every letter, evenly spaced over each letter's images,
+        and at least one image of each letter that has more than one is held out for evaluation.
+
+        Returns:
+            (calibration, evaluation) (tuple): lists of (path, letter), in the order of samples
+        '''
+        by_letter = {}
+        for index, (_, letter) in enumerate(samples):
+            by_letter.setdefault(letter, []).append(index)
+        capacity = {letter: max(len(indices) - 1, 1) for letter, indices in by_letter.items()}
+        counts = dict.fromkeys(by_letter, 0)
+        remaining = min(max_calibration, sum(capacity.values()))
+        while remaining > 0:
+            for letter in by_letter:
+                if remaining > 0 and counts[letter] < capacity[letter]:
+                    counts[letter] += 1
+                    remaining -= 1
+        chosen = set()
+        for letter, indices in by_letter.items():
+            step = len(indices) / counts[letter] if counts[letter] else 0
+            chosen.update(indices[int((j + 0.5) * step)] for j in range(counts[letter]))
+        return ([sample for index, sample in enumerate(samples) if index in chosen],
+                [sample for index, sample in enumerate(samples) if index not in chosen])
+
+    def quantize(self, model_fpath, calibration_dir, mode='static', max_calibration=256):
+        '''Post-training INT8 quantization of the loaded learner, saved for the int8 backend
+
+        Args:
+            model_fpath (string): path of the learner pickle, the quantized model and report are written next to it
+            calibration_dir (string): labeled images in the create_photos.py layout, used to calibrate and evaluate
+            mode (string): 'static' quantizes the backbone and head, 'dynamic' only the linear layers of the head
+            max_calibration (int): number of images used to calibrate the static observers, see split_calibration;
+                accuracy is reported on the other images
+
+        Returns:
+            report (dict): fp32 vs int8 accuracy, agreement, latency and model size
+        '''
+        if not self._fast_path:
+            self._prepare_fast_path()
+        samples = self.labeled_images(calibration_dir)
+        if not samples:
+            raise ValueError(f"No labeled images found in {calibration_dir}")
+        # dynamic quantization needs no calibration, every image is used for evaluation
+        calibration, evaluation = self.split_calibration(samples, max_calibration) if mode == 'static' else ([], samples)
+        if not evaluation:
+            # too few images to hold any out, the accuracy is measured on the calibration images
+            evaluation = calibration
+        engine = self._quantized_engine()
+        torch.backends.quantized.engine = engine
+        example = torch.zeros(1, 3, *self._size)
+        fp32 = self._net
+        if mode == 'dynamic':
+            int8 = torch.ao.quantization.quantize_dynamic(copy.deepcopy(fp32), {nn.Linear}, dtype=torch.qint8)
+        elif mode == 'static':
+            from torch.ao.quantization import get_default_qconfig_mapping
+            from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+            prepared = prepare_fx(copy.deepcopy(fp32), get_default_qconfig_mapping(engine), (example,))
+            # observers update their buffers in place, so calibrate under no_grad rather than inference_mode
+            with torch.no_grad():
+                for i in range(0, len(calibration), 32):
+                    prepared(torch.from_numpy(self._preprocess([path for path, _ in calibration[i:i + 32]])))
+            int8 = convert_fx(prepared)
+        else:
+            raise ValueError(f"Unknown quantization mode {mode}, expected 'static' or 'dynamic'")
+
+        fp32_preds, fp32_acc, fp32_ms = self._evaluate(fp32, evaluation)
+        int8_preds, int8_acc, int8_ms = self._evaluate(int8, evaluation)
+
+        # persist as TorchScript so the int8 backend needs no fastai at runtime
+        artifact, meta = self.export_paths(model_fpath, 'int8')
+        with torch.no_grad():
+            torch.jit.freeze(torch.jit.trace(int8.eval(), example)).save(str(artifact))
+        self._write_meta(meta)
+
+        def size_of(net):
+            buffer = io.BytesIO()
+            torch.save(net.state_dict(), buffer)
+            return buffer.tell()
+
+        report = {'mode': mode, 'engine': engine, 'samples': len(samples),
+                  'calibration_samples': len(calibration), 'evaluation_samples': len(evaluation),
+                  'held_out': evaluation is not calibration,
+                  'fp32_accuracy': fp32_acc, 'int8_accuracy': int8_acc,
+                  'agreement': sum(a == b for a, b in zip(fp32_preds, int8_preds)) / len(evaluation),
+                  'fp32_ms_per_image': fp32_ms, 'int8_ms_per_image': int8_ms,
+                  'fp32_size_bytes': size_of(fp32), 'int8_size_bytes': size_of(int8)}
+        with open(Path(model_fpath).with_suffix('.int8.report.json'), "w") as f:
+            json.dump(report, f, indent=4)
+        return report
+
+    def _preprocess(self, images):
+        # one resize and one normalize, matching ToTensor -> IntToFloatTensor -> Normalize of the learner
+        batch = []
+        for img in images:
+            img = Image.fromarray(img) if isinstance(img, np.ndarray) else Image.open(img).convert('RGB')
+            # PIL sizes are width, height
+            if img.size != self._size[::-1]:
+                img = img.resize(self._size[::-1])
+            batch.append(np.asarray(img).transpose(2, 0, 1))
+        x = np.stack(batch).astype(np.float32) / np.float32(255.)
+        if self._mean is not None:
+            x = (x - self._mean) / self._std
+        return x
+
+    def _fast_predict(self, images):
+        # forward pass on the bare network, returns one row of probabilities per image
+        with span("model.preprocess"):
+            x = self._preprocess(images)
+        with span("model.forward"):
+            if self._backend == 'onnx':
+                return self._session.run(None, {'image': x})[0]
+            with torch.inference_mode():
+                return self._net(torch.from_numpy(x))
     
     def make_prediction(self, img_path):
         '''Predicts what letter is depicted in the image provided to the function
 
         Args: 
-            img_path (string): hold the relative local path to the image to be processed
+            img_path (string or ndarray): relative local path to the image to be processed, or an RGB frame already in memory
 
         Returns:
             predicted_letter (string): upper letter identified in the image
             probability (list of ints): index corresponds to letter in the alphabet; value represents confidence on scale of 0.0 to 1.0
+                (a tensor, or an ndarray with the onnx backend)
         '''
         try:
-            img = PILImage.create(img_path)
-            img = img.resize((192, 192))
-            predicted_letter, _, probability = self._loaded_model.predict(img)
+            count("model.predictions")
+            if self._fast_path:
+                probability = self._fast_predict([img_path])[0]
+                return self._vocab[int(probability.argmax())], probability
+            with span("model.preprocess"):
+                img = fv.PILImage.create(img_path)
+                img = img.resize((192, 192))
+            with span("model.forward"):
+                predicted_letter, _, probability = self._loaded_model.predict(img)
             return predicted_letter, probability
         except:
             print("Error! Cannot open image.")
 
-class User:
-    '''Functionalities for the User class: 
-        - create/edit/view a profile
-        - keep track of their scores on various trials
-        - display their progress over time
+    def predict_iter(self, images, batch_size=32):
+        '''Streams predictions for many images, running them through the network batch_size at a time
 
-    FUTURE DEVELOPMENT NOTE: could have different levels of user which have access to different prompt sets or types of services;
-    this could allow us to implement inheritance
+        Args:
+            images (iterable or string): image paths and/or RGB frames, or a directory to search for images
+            batch_size (int): number of images per forward pass
 
-    Attributes: 
-        _name (string): username
-        _proficiency (string): quantized level user is on
-        _score_history (int): last (up to) 50 scores for a specific letter stored as 0=incorrect or 1=correct
-        _w_let_scores (int): weighted letter scores
-        _p_let_scores (float): letter scores on a scale of 0-100 (%)
-        _overall_score (float): equally weighted average of letter scores
+        Yields:
+            predicted_letter (string): upper letter identified in the image
+            probability (tensor): same as make_prediction
+        '''
+        if isinstance(images, (str, Path)) and Path(images).is_dir():
+            images = sorted(path for path in Path(images).rglob('*') if path.suffix.lower() in IMAGE_EXTENSIONS)
+        images = iter(images)
+        while True:
+            # same preprocessing as make_prediction, one batch at a time so memory stays bounded
+            batch = list(islice(images, batch_size))
+            if not batch:
+                return
+            if self._fast_path:
+                for probability in self._fast_predict(batch):
+                    yield self._vocab[int(probability.argmax())], probability
+                continue
+            learn = self._loaded_model
+            batch = [fv.PILImage.create(img).resize((192, 192)) for img in batch]
+            dl = learn.dls.test_dl(batch, bs=batch_size)
+            with learn.no_bar(), torch.inference_mode():
+                probabilities, _ = learn.get_preds(dl=dl)
+            for probability in probabilities:
+                yield learn.dls.vocab[int(probability.argmax())], probability
+
+    def predict_batch(self, images, batch_size=32):
+        '''Predicts the letters for many images at once, see predict_iter
+
+        Returns:
+            predicted_letters (list of strings): one letter per image, in input order
+            probabilities (tensor): one row of letter probabilities per image
+        '''
+        letters, probabilities = [], []
+        for letter, probability in self.predict_iter(images, batch_size):
+            letters.append(letter)
+            probabilities.append(probability)
+        if self._backend == 'onnx':
+            return letters, np.stack(probabilities) if probabilities else np.empty(0)
+        return letters, torch.stack(probabilities) if probabilities else torch.empty(0)
+
+class FrameSource(ABC):
+    '''Functionalities of this class:
+    - base class of the frame sources a Camera captures from, all sharing the cv2.VideoCapture read API
+    - subclasses produce the frame of an index in _frame, read paces and copies it
+    - pace frames at a target frame rate like a live camera, and timestamp them on the time.perf_counter clock
+
+    Attributes:
+        fps (float): target frame rate, 0 or None delivers frames as fast as they are read
+        realtime (bool): skip frames that were due while nobody read, like a camera; False delivers every frame in order
+        timestamp (float): perf_counter time the latest frame was (nominally) captured
+        _start (float): time of frame 0, set by the first read
+        _index (int): index of the latest frame, -1 before the first read
     '''
-    def __init__(self, name, proficiency):
-        self._name = name
-        self._proficiency = proficiency
-        self._score_history = [[] for x in range(26)]
-        self._w_let_scores = [0 for x in range(26)]
-        self._p_let_scores = [0 for x in range(26)]
-        self._overall_score = 0.0
-
-    def display_profile(self): 
-        return ("User: ", self._name, "\nProficiency: ", self._proficiency)
-
-    def update_profile(self): # eventually not needed
-        new_name = input("Enter new profile name or * to cancel: ")
-        setattr(self, '_name', new_name) and (result:= (f"New name: {self._name}")) if new_name != '*' else (result:= ("Cancelled."))
-        return result
-    
-    def check_score(self):
-        return self._score
-
-    def update_proficiency(self):
-        if self._overall_score < MIN_LEVEL:
-            self._proficiency = "Beginner"
-        elif self._overall_score < MED_LEVEL:
-            self._proficiency = "Intermediate"
-        elif self._overall_score < MAX_LEVEL:
-            self._proficiency = "Advanced"
-        else:
-            self._proficiency = "Signed Language Sensei"
-    
-    def check_proficiency(self):
-        return self._proficiency
+    def __init__(self, fps=None, realtime=True):
+        self.fps = fps
+        self.realtime = realtime
+        self.timestamp = None
+        self._start = None
+        self._index = -1
+
+    def configure(self, width=None, height=None, fps=None):
+        # only the frame rate applies to replayed frames
+        if fps != None:
+            self.fps = fps
+            self._start = None
+
+    def _next_index(self):
+        # index of the frame to deliver next, blocking until it is due
+        now = time.perf_counter()
+        if not self.fps:
+            self._index += 1
+            self.timestamp = now
+            return self._index
+        if self._start == None:
+            self._start = now - (self._index + 1) / self.fps
+        index = self._index + 1
+        if self.realtime:
+            index = max(index, int((now - self._start) * self.fps))
+        due = self._start + index / self.fps
+        if due > now:
+            time.sleep(due - now)
+        self._index = index
+        self.timestamp = due
+        return index
+
+    def read(self, image=None):
+        '''Reads the next frame, like cv2.VideoCapture.read
+
+        Args:
+            image (ndarray): buffer to read into, used if it has the frame's shape
+
+        Returns:
+            (result, frame) (tuple): whether a frame was read, and the BGR frame
+        '''
+        index = self._next_index()
+        frame = self._frame(index)
+        if frame is None:
+            return False, None
+        if image is not None and image.shape == frame.shape and image.dtype == frame.dtype:
+            np.copyto(image, frame)
+            return True, image
+        return True, frame.copy()
+
+    @abstractmethod
+    def _frame(self, index):
+        # BGR frame of the given index, None when the source has no more frames
+        pass
+
+    def release(self):
+        pass
+
+class WebcamSource(FrameSource):
+    '''Functionalities of this class:
+    - capture from a webcam through OpenCV, frames are timestamped when they are read
+
+    Attributes:
+        _capture (cv2.VideoCapture): opened webcam
+    '''
+    def __init__(self, index=0):
+        super().__init__()
+        _import_cv2()
+        try:
+            self._capture = cv2.VideoCapture(index)
+        except:
+            print("Error! Camera cannot be opened")
+
+    def configure(self, width=None, height=None, fps=None):
+        # requested capture resolution and frame rate, the driver may pick the nearest it supports
+        for prop, value in ((cv2.CAP_PROP_FRAME_WIDTH, width), (cv2.CAP_PROP_FRAME_HEIGHT, height), (cv2.CAP_PROP_FPS, fps)):
+            if value != None:
+                self._capture.set(prop, value)
+
+    def read(self, image=None):
+        # the driver paces the frames itself
+        result, image = self._capture.read(image) if image is not None else self._capture.read()
+        self.timestamp = time.perf_counter()
+        return result, image
+
+    def _frame(self, index):
+        # read overrides the paced read, which would copy every frame once more
+        result, frame = self._capture.read()
+        return frame if result else None
+
+    def release(self):
+        self._capture.release()
+
+class VideoFileSource(FrameSource):
+    '''Functionalities of this class:
+    - replay a video file at its own or a target frame rate, looping at the end
+
+    Attributes:
+        path (string): video file
+        loop (bool): start over at the end of the file, otherwise reads fail from then on
+        _capture (cv2.VideoCapture): opened file
+        _position (int): index of the frame the file decodes next, counted across loops
+    '''
+    def __init__(self, path, fps=None, loop=True, realtime=True):
+        _import_cv2()
+        self.path = str(path)
+        self._capture = cv2.VideoCapture(self.path)
+        if not self._capture.isOpened():
+            raise ValueError(f"Cannot open video file {self.path}")
+        super().__init__(fps if fps != None else self._capture.get(cv2.CAP_PROP_FPS), realtime)
+        self.loop = loop
+        self._position = 0
+
+    def _frame(self, index):
+        # frames due while nobody read are skipped without converting them
+        for _ in range(index - self._position):
+            if not self._capture.grab() and not (self._rewind() and self._capture.grab()):
+                return None
+        self._position = index + 1
+        result, frame = self._capture.read()
+        if not result and self._rewind():
+            result, frame = self._capture.read()
+        return frame if result else None
+
+    def _rewind(self):
+        if not self.loop:
+            return False
+        return self._capture.set(cv2.CAP_PROP_POS_FRAMES, 0)
+
+    def release(self):
+        self._capture.release()
+
+class ImageDirectorySource(FrameSource):
+    '''Functionalities of this class:
+    - replay the images of a create_photos.py directory (<letter>/<letter>N.jpg) at a target frame rate, looping
+    - replay a single letter's images, e.g. the letter a simulated learner is signing
+
+    Attributes:
+        directory (string): dataset directory
+        label (string): letter of the latest frame
+        _images (list): (path, letter) of every image, in file order
+        _letter (string): letter being replayed, None for all of them
+        _cache (dict): path -> decoded frame, None when frames are decoded on every read
+    '''
+    def __init__(self, directory, fps=30, realtime=True, cache=False):
+        super().__init__(fps, realtime)
+        self.directory = str(directory)
+        self._images = Model.labeled_images(directory)
+        if not self._images:
+            raise ValueError(f"No labeled images in {self.directory}")
+        self._letter = None
+        self._selected = self._images
+        self._cache = {} if cache else None
+        self.label = None
+
+    def show(self, letter=None):
+        # replay only the images of one letter from now on, None for all images
+        selected = [item for item in self._images if letter == None or item[1] == letter]
+        if not selected:
+            raise ValueError(f"No images of letter {letter} in {self.directory}")
+        self._letter, self._selected = letter, selected
+
+    def _frame(self, index):
+        path, self.label = self._selected[index % len(self._selected)]
+        if self._cache is not None and path in self._cache:
+            return self._cache[path]
+        with Image.open(path) as img:
+            # frames are BGR, as a camera delivers them
+            frame = np.ascontiguousarray(np.asarray(img.convert('RGB'))[..., ::-1])
+        if self._cache is not None:
+            self._cache[path] = frame
+        return frame
+
+class SyntheticSource(FrameSource):
+    '''Functionalities of this class:
+    - generate frames without any camera or files, deterministic for a given seed
+    - by default random frames of the model input size, whose first pixel holds the index of the letter being shown
+      in every channel
+
+    Attributes:
+        generator (callable): called with (frame index, letter), returns a BGR frame; None for the default frames
+        capture_delay (float): seconds each frame takes to capture on top of the pacing, like the exposure and
+            transfer time of a webcam
+        _letter (string): letter being shown
+        _pools (dict): letter -> pregenerated default frames
+    '''
+    def __init__(self, fps=30, realtime=True, width=192, height=192, generator=None, seed=0, pool_size=4, capture_delay=0.0):
+        super().__init__(fps, realtime)
+        self.generator = generator
+        self.capture_delay = capture_delay
+        self.width, self.height = width, height
+        self._rng = np.random.default_rng(seed)
+        self._pool_size = pool_size
+        self._pools = {}
+        self._letter = 'a'
+
+    def configure(self, width=None, height=None, fps=None):
+        super().configure(fps=fps)
+        if width != None or height != None:
+            self.width, self.height = width or self.width, height or self.height
+            self._pools = {}
+
+    def show(self, letter):
+        self._letter = letter
+
+    def _frame(self, index):
+        if self.capture_delay:
+            time.sleep(self.capture_delay)
+        if self.generator != None:
+            return self.generator(index, self._letter)
+        pool = self._pools.get(self._letter)
+        if pool is None:
+            pool = self._rng.integers(0, 256, size=(self._pool_size, self.height, self.width, 3), dtype=np.uint8)
+            pool[:, 0, 0, :] = ord(self._letter) - ord('a')
+            self._pools[self._letter] = pool
+        return pool[index % len(pool)]
 
 class Camera:
     '''Functionalities of the camera class:
-    - to take a picture and save it in a cache
+    - to take a picture and keep it in memory (optionally saving it to disk)
+    - to read a stream of frames for live recognition
+    - to capture continuously on a background thread into a ring buffer of the latest frames
     - to open/view an image
     
+    - to capture from pluggable frame sources: a webcam by default, or a video file, an image directory or
+      synthetic frames, so the capture->predict pipeline also runs without a webcam
+
     Attributes:
-        _camera: allows access to camera
-        _new_image_path (string): name of new image file
+        _camera (FrameSource): source the frames are read from
+        _new_image (ndarray): latest captured frame, resized and in RGB order
+        _new_image_path (string): name of new image file, None if the latest frame was not saved
+        _new_image_time (float): perf_counter timestamp of _new_image
+        _frame_time (float): perf_counter timestamp of the latest frame read_frame returned
+        _ring (ndarray): preallocated buffer of the latest raw frames, allocated on the first frame (threaded only)
+        _ring_times (ndarray): perf_counter timestamp of each frame in the ring
+        _frame_count (int): number of frames written to the ring so far, the latest is at (_frame_count - 1) % ring size
+        _frame_ready (Condition): guards the ring and wakes up wait_for_new
+        _capture_thread (Thread): background capture thread, None when not threaded
     '''
-    def __init__(self):
-        try: 
-            self._camera = cv2.VideoCapture(0)
-        except: 
-            print("Error! Camera cannot be opened")
+    def __init__(self, threaded=False, ring_size=4, width=None, height=None, fps=None, source=None):
+        self._camera = source if source != None else WebcamSource(0)
+        self.configure(width, height, fps)
+        self._new_image = None
         self._new_image_path = None
+        self._new_image_time = None
+        self._frame_time = None
+        self._ring = None
+        self._ring_times = np.zeros(max(2, ring_size))
+        self._frame_count = 0
+        self._frame_ready = threading.Condition()
+        self._capturing = False
+        self._capture_thread = None
+        if threaded:
+            self.start_capture()
+
+    def configure(self, width=None, height=None, fps=None):
+        self._camera.configure(width, height, fps)
+
+    def start_capture(self):
+        if self._capturing:
+            return
+        self._capturing = True
+        self._capture_thread = threading.Thread(target=self._capture_loop, name="camera-capture", daemon=True)
+        self._capture_thread.start()
+
+    def is_capturing(self):
+        return self._capturing
+
+    def stop_capture(self):
+        self._capturing = False
+        if self._capture_thread != None:
+            self._capture_thread.join(timeout=2)
+            self._capture_thread = None
+        with self._frame_ready:
+            self._frame_ready.notify_all()
 
-    def take_image(self):
-        # captures image from camera and assigns path to Camera instance
-        result, image = self._camera.read()
-        if result:
-            img_path = "new_image.png" 
-            image = cv2.resize(image, (192, 192))
-            cv2.imwrite(img_path, image)
-            self._new_image_path = img_path
-            return (f"Image saved as {img_path}")
+    def release(self):
+        self.stop_capture()
+        self._camera.release()
+
+    def _capture_loop(self):
+        while self._capturing:
+            slot = self._frame_count % len(self._ring_times)
+            # read straight into the next ring slot, readers only ever copy the latest (other) slot
+            if self._ring is not None:
+                result, image = self._camera.read(self._ring[slot])
+            else:
+                result, image = self._camera.read()
+            timestamp = self._camera.timestamp
+            if not result:
+                time.sleep(0.01)
+                continue
+            with self._frame_ready:
+                if self._ring is None or self._ring.shape[1:] != image.shape:
+                    self._ring = np.empty((len(self._ring_times),) + image.shape, dtype=image.dtype)
+                if not np.shares_memory(image, self._ring[slot]):
+                    self._ring[slot] = image
+                self._ring_times[slot] = timestamp
+                self._frame_count += 1
+                self._frame_ready.notify_all()
+
+    def latest(self):
+        # non-blocking: (timestamp, raw BGR frame) of the newest captured frame, (None, None) before the first one
+        with self._frame_ready:
+            if self._frame_count == 0:
+                return None, None
+            slot = (self._frame_count - 1) % len(self._ring_times)
+            return self._ring_times[slot], self._ring[slot].copy()
+
+    def wait_for_new(self, timeout=1.0):
+        # blocks until a frame newer than the current latest one arrives, then returns it like latest
+        with self._frame_ready:
+            seen = self._frame_count
+            self._frame_ready.wait_for(lambda: self._frame_count > seen or not self._capturing, timeout)
+        return self.latest()
+
+    def read_frame(self, wait_new=False):
+        # reads one frame resized to the model input, in RGB order; None if the camera returned nothing
+        # wait_new waits for a frame newer than the latest one, so a stream of reads never repeats a frame
+        with span("camera.read"):
+            if self._capturing:
+                # the capture thread keeps the ring fresh, so this is a memory read
+                timestamp, image = self.latest() if not wait_new else (None, None)
+                if image is None:
+                    timestamp, image = self.wait_for_new()
+                result = image is not None
+            else:
+                result, image = self._camera.read()
+                timestamp = self._camera.timestamp
+        if not result:
+            count("camera.failed_reads")
+            return None
+        self._frame_time = timestamp
+        with span("camera.resize"):
+            if image.shape[:2] != (192, 192):
+                # sources without a webcam or video file do not need opencv, PIL resizes for them
+                image = cv2.resize(image, (192, 192)) if cv2 != None else np.asarray(Image.fromarray(image).resize((192, 192), Image.BILINEAR))
+            # frames are BGR, the model and Qt expect RGB
+            return np.ascontiguousarray(image[..., ::-1])
+
+    def take_image(self, save=False, img_path="new_image.png"):
+        # captures image from camera and keeps the resized frame in memory; only written to disk when requested
+        image = self.read_frame()
+        if image is not None:
+            self._new_image_path = None
+            if save:
+                with span("camera.encode"):
+                    Image.fromarray(image).save(img_path)
+                self._new_image_path = img_path
+            self._new_image = image
+            self._new_image_time = self._frame_time
+            return (f"Image saved as {img_path}") if save else ("Image captured.")
         else:
             return ("Image not captured.")
 
     def view_image(self, img_path=None, wid=192, len=192): # probably not needed long term
-        image = cv2.imread(img_path if img_path != None else self._new_image_path)
+        _import_cv2()
+        if img_path == None and self._new_image_path == None:
+            image = cv2.cvtColor(self._new_image, cv2.COLOR_RGB2BGR)
+        else:
+            image = cv2.imread(img_path if img_path != None else self._new_image_path)
         cv2.imshow("Image Window", image)
         cv2.waitKey(0)
         cv2.destroyAllWindows()
@@ -0,0 +1,209 @@
+'''File name: benchmarks.py
+Contributers: Zoe Takacs and Wyatt Shaw
+Info: Headless microbenchmarks of the model, scoring and persistence hot paths, compared against a stored baseline
+Note: NOT used to run the application; e.g. python benchmarks.py --suite scoring,db --sizes 1000,100000
+      writes JSON results and exits with status 1 when a benchmark is slower than the baseline allows
+'''
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from base_classes import Model, User
+from controller_classes import UserController
+from user_database import Database, PickleDatabase, RecordDatabase
+
+SUITES = ('model', 'scoring', 'db')
+SAMPLE_IMAGES = ('default_img.png', 'new_image.png')
+DEFAULT_SIZES = (1000, 100000, 1000000)
+# the JSON database stores each result on its own indented line (about 12 KB per user), a million users would need 12 GB
+SIZE_LIMITS = {'Database': 100000}
+BASELINE = 'benchmark_baseline.json'
+
+def summarize(samples):
+    # latency summary of a list of durations in seconds
+    samples = np.asarray(samples, dtype=np.float64)
+    p50, p95, p99 = np.percentile(samples, [50, 95, 99])
+    return {'unit': 's', 'n': int(samples.size), 'p50': float(p50), 'p95': float(p95), 'p99': float(p99),
+            'mean': float(samples.mean()), 'min': float(samples.min())}
+
+def time_calls(fn, repeat, warmup=1):
+    # durations of repeat calls of fn, after warmup calls that are not recorded
+    for _ in range(warmup):
+        fn()
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+    return samples
+
+def synthetic_users(count, user_controller, history=20, profiles=64, seed=0):
+    # count users with random histories; a few scored profiles are copied, scoring every user would dominate the setup
+    rng = np.random.default_rng(seed)
+    prototypes = []
+    for i in range(profiles):
+        user = User(f"profile{i}", "Beginner")
+        user._score_history = rng.integers(0, 2, size=(26, history)).tolist()
+        user_controller.recompute_scores(user)
+        user.update_proficiency()
+        prototypes.append(user)
+    users = {}
+    for i in range(count):
+        user = prototypes[i % profiles].copy()
+        user._name = f"user{i}"
+        users[user._name] = user
+    return users
+
+def json_users(users):
+    # JSON databases hold plain attribute dictionaries, in the layout User.__setstate__ reads
+    return {name: {'_name': name, '_proficiency': user._proficiency, '_score_history': user._score_history,
+                   '_overall_score': user._overall_score, '_w_let_scores': user._w_let_scores.tolist(),
+                   '_p_let_scores': user._p_let_scores.tolist()}
+            for name, user in users.items()}
+
+def bench_model(args, results):
+    if not os.path.exists(args.model):
+        results['model'] = {'skipped': f"model file {args.model} not found"}
+        return
+    model = Model(args.model, fast_path=args.fast_path, backend=args.backend)
+    if not model.is_loaded():
+        results['model'] = {'skipped': f"model {args.model} could not be loaded with the {args.backend} backend"}
+        return
+    rng = np.random.default_rng(0)
+    synthetic = rng.integers(0, 256, size=(192, 192, 3), dtype=np.uint8)
+    results['model.make_prediction.synthetic'] = summarize(
+        time_calls(lambda: model.make_prediction(synthetic), args.repeat, warmup=3))
+    for image in SAMPLE_IMAGES:
+        if os.path.exists(image):
+            results[f'model.make_prediction.{image}'] = summarize(
+                time_calls(lambda: model.make_prediction(image), args.repeat, warmup=3))
+
+def bench_scoring(args, user_controller, results):
+    rng = np.random.default_rng(1)
+    users = list(synthetic_users(args.scoring_users, user_controller, history=args.history).values())
+    lessons = rng.integers(0, 2, size=(64, 26)).tolist()
+    calls = iter(range(1 << 62))
+
+    def update_score():
+        i = next(calls)
+        user_controller.update_score(users[i % len(users)], lessons[i % len(lessons)])
+
+    # many calls per lesson are cheap, so every sample is one call
+    results['scoring.update_score'] = summarize(time_calls(update_score, args.repeat * 100, warmup=100))
+
+    def recompute():
+        user = users[next(calls) % len(users)]
+        user_controller.recompute_scores(user)
+
+    results['scoring.recompute_scores'] = summarize(time_calls(recompute, args.repeat * 10, warmup=10))
+
+def bench_databases(args, user_controller, results, tmp_dir):
+    for size in args.sizes:
+        users = synthetic_users(size, user_controller, history=args.history)
+        for db_class in (PickleDatabase, RecordDatabase, Database):
+            name = db_class.__name__
+            key = f'db.{name}.{{}}.{size}'
+            if size > SIZE_LIMITS.get(name, size) and not args.full:
+                results[key.format('save_db')] = results[key.format('load_db')] = {
+                    'skipped': f"{name} is limited to {SIZE_LIMITS[name]} users, use --full to run it"}
+                continue
+            db = db_class(os.path.join(tmp_dir, f"bench_{size}.json" if db_class is Database else f"bench_{size}"))
+            data = json_users(users) if db_class is Database else users
+            db.db_data = data
+            results[key.format('save_db')] = summarize(time_calls(lambda: db.save_db(data), args.db_repeat, warmup=0))
+            results[key.format('load_db')] = summarize(time_calls(db.load_db, args.db_repeat, warmup=0))
+            results[key.format('file_size')] = {'unit': 'bytes', 'value': os.path.getsize(db.db_name)}
+            os.remove(db.db_name)
+            del data
+        del users
+
+def compare(results, baseline, tolerance):
+    '''Ratio of each latency to the baseline, by p50 and p95
+
+    Returns:
+        comparison (dict): benchmark -> ratios and whether p50 is more than tolerance slower than the baseline
+    '''
+    comparison = {}
+    for key, result in results.items():
+        previous = baseline.get(key)
+        if not previous or 'p50' not in result or 'p50' not in previous:
+            continue
+        p50_ratio = result['p50'] / previous['p50'] if previous['p50'] else float('inf')
+        p95_ratio = result['p95'] / previous['p95'] if previous['p95'] else float('inf')
+        comparison[key] = {'p50_ratio': p50_ratio, 'p95_ratio': p95_ratio, 'regression': p50_ratio > 1 + tolerance}
+    return comparison
+
+def run(args):
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # a throwaway database with room for every scored user, update_score only publishes and marks the user as changed
+        user_controller = UserController(os.path.join(tmp_dir, "bench_users"), backend='sqlite',
+                                         cache_size=max(256, args.scoring_users))
+        try:
+            if 'model' in args.suite:
+                bench_model(args, results)
+            if 'scoring' in args.suite:
+                bench_scoring(args, user_controller, results)
+            if 'db' in args.suite:
+                bench_databases(args, user_controller, results, tmp_dir)
+        finally:
+            user_controller.close()
+    return results
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Headless microbenchmarks")
+    parser.add_argument("--suite", default=",".join(SUITES), help=f"comma separated subset of {','.join(SUITES)}")
+    parser.add_argument("--sizes", default=",".join(map(str, DEFAULT_SIZES)), help="user counts for the db suite")
+    parser.add_argument("--full", action="store_true", help="run the JSON database at every size")
+    parser.add_argument("--repeat", type=int, default=50, help="samples per model benchmark")
+    parser.add_argument("--db-repeat", type=int, default=5, help="samples per database benchmark")
+    parser.add_argument("--scoring-users", type=int, default=1000)
+    parser.add_argument("--history", type=int, default=20, help="attempts per letter of the synthetic users")
+    parser.add_argument("--model", default="Zoya_Letters_EP10.pkl")
+    parser.add_argument("--backend", default="fastai", choices=Model.BACKENDS)
+    parser.add_argument("--fast-path", action="store_true", help="run the fastai model without the Learner")
+    parser.add_argument("--output", help="results file, printed when omitted")
+    parser.add_argument("--baseline", default=BASELINE, help="results to compare against, if the file exists")
+    parser.add_argument("--save-baseline", action="store_true", help="store these results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed p50 slowdown against the baseline")
+    args = parser.parse_args(argv)
+    args.suite = [suite for suite in args.suite.split(",") if suite]
+    unknown = set(args.suite) - set(SUITES)
+    if unknown:
+        parser.error(f"unknown suite {', '.join(sorted(unknown))}")
+    args.sizes = [int(size) for size in args.sizes.split(",") if size]
+
+    results = run(args)
+    report = {'meta': {'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': platform.python_version(),
+                       'platform': platform.platform(), 'numpy': np.__version__, 'cpus': os.cpu_count(),
+                       'suites': args.suite},
+              'results': results}
+    regressions = []
+    if os.path.exists(args.baseline) and not args.save_baseline:
+        with open(args.baseline) as f:
+            report['comparison'] = compare(results, json.load(f)['results'], args.tolerance)
+        regressions = [key for key, ratios in report['comparison'].items() if ratios['regression']]
+        report['regressions'] = regressions
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text)
+    else:
+        print(text)
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            f.write(text)
+    for key in regressions:
+        ratios = report['comparison'][key]
+        print(f"Error! {key} p50 is {ratios['p50_ratio']:.2f}x the baseline", file=sys.stderr)
+    return 1 if regressions else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -2,9 +2,22 @@
 Contributers: Zoe Takacs and Wyatt Shaw
 Info: SessionController and UserController class definition
 '''
-from base_classes import User, Model, Camera
-from user_database import PickleDatabase
+from base_classes import Model, Camera
+from user_profile import User, decay_weights, letter_scores, score_sums
+from user_database import JournaledPickleDatabase, RecordDatabase, SqliteDatabase, WriteBehindDatabase
+from metrics import span
+from profiling import PROFILER
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from string import ascii_lowercase
+import csv
+import json
 import logging
+import os
+import threading
+import time
+import weakref
 import numpy as np
 
 logger = logging.getLogger(__name__)
@@ -14,106 +27,695 @@ class SessionController:
     '''Functionalities of this class:
     - Initializes the camera and model objects
     - Makes connections between the camera, model, user classes
+    - Runs capture and prediction on a worker thread so the GUI never blocks
 
     Attributes:
     _camera (Camera): allows camera access
     _model (Model): allows access to model
+    _save_images (bool): also write each capture to disk, frames are otherwise passed in memory only
+    _executor (ThreadPoolExecutor): single inference worker, so camera reads and forward passes of captures never overlap
+    _model_lock (Lock): held for every forward pass, captures and live recognition share a model that is not thread-safe
+    _request_id (int): id of the latest asynchronous request, older results are dropped
+    _pending (Future): latest asynchronous request
+    _load_state (string): 'ready', 'loading' or 'failed'
+    _load_started (float): time the model started loading, used to report progress
+    _model_future (Future): background model load, None when the model was loaded synchronously
+    _live (LiveRecognizer): live recognition on the camera stream, None unless live mode is on
+    _live_feed (Thread): reads the frames of the capture thread for live mode, so the GUI thread never reads the camera
     '''
-    def __init__(self, model_fpath=None):
-        self._camera = Camera()
-        if model_fpath != None:
-            self._model = Model(model_fpath)
+    def __init__(self, model_fpath=None, save_images=False, load_async=False, camera=None, model=None):
+        self._camera = camera if camera != None else Camera()
+        self._save_images = save_images
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="inference")
+        self._model_lock = threading.Lock()
+        self._request_id = 0
+        self._pending = None
+        self._model = None
+        self._model_future = None
+        self._load_state = 'ready'
+        self._load_started = time.perf_counter()
+        self._live = None
+        self._live_feed = None
+        if model != None:
+            # already loaded, e.g. one model shared by several sessions
+            self._model = model
+        elif model_fpath != None and load_async:
+            # load on the inference worker, captures submitted meanwhile simply queue up behind it
+            self._load_state = 'loading'
+            self._model_future = self._executor.submit(self._load_model, model_fpath)
+        elif model_fpath != None:
+            self._load_model(model_fpath)
+
+    def _load_model(self, model_fpath):
+        model = Model(model_fpath)
+        self._model = model
+        self._load_state = 'ready' if model.is_loaded() else 'failed'
+        logger.info(f'Model {self._load_state} after {time.perf_counter() - self._load_started:.1f}s')
+
+    def is_ready(self):
+        return self._load_state == 'ready'
+
+    def load_status(self):
+        # state and seconds spent loading so far, for progress display
+        return self._load_state, time.perf_counter() - self._load_started
+
+    def wait_until_ready(self, timeout=None):
+        # block until the background load has finished, returns whether the model is usable
+        if self._model_future != None:
+            self._model_future.result(timeout)
+        return self.is_ready()
+
+    def on_ready(self, callback):
+        # call back (from the worker thread) once loading has finished, or right away if it already has
+        if self._model_future != None:
+            self._model_future.add_done_callback(lambda f: callback())
         else:
-            self._model = None
+            callback()
 
     def capture_and_predict(self):
-        self._camera.take_image()
-        if self._model != None:
-            letter, probability = self._model.make_prediction(self._camera._new_image_path)
-            logger.info(f'Predicted letter {letter}')
-            return letter, probability
-        else:
-            return None, None
+        self.wait_until_ready()
+        try:
+            with span("session.capture_and_predict"), PROFILER.section():
+                self._camera.take_image(save=self._save_images)
+                if self._model != None:
+                    # hand the frame straight to the model instead of reading it back from disk
+                    with self._model_lock:
+                        letter, probability = self._model.make_prediction(self._camera._new_image)
+                    logger.info(f'Predicted letter {letter}')
+                    return letter, probability
+                else:
+                    return None, None
+        finally:
+            # ends a profiling window of the next few captures
+            PROFILER.capture_done()
+
+    def _capture_and_predict_frame(self):
+        # runs on the worker thread, returns the frame too since a later capture may replace it
+        letter, probability = self.capture_and_predict()
+        return letter, probability, self.get_last_frame()
+
+    def capture_and_predict_async(self, callback=None):
+        '''Runs capture_and_predict on the inference worker thread
+
+        Args:
+            callback (callable): called with the finished future, from the worker thread, unless the
+                request was cancelled or superseded by a newer one
+
+        Returns:
+            future (Future): resolves to (letter, probability, frame)
+        '''
+        self._request_id += 1
+        request_id = self._request_id
+        future = self._executor.submit(self._capture_and_predict_frame)
+        if callback != None:
+            future.add_done_callback(lambda f: callback(f) if not f.cancelled() and request_id == self._request_id else None)
+        self._pending = future
+        return future
+
+    def cancel_capture(self):
+        # drop the result of the pending request and skip it entirely if it has not started yet
+        self._request_id += 1
+        if self._pending != None:
+            self._pending.cancel()
+            self._pending = None
+
+    def shutdown(self):
+        self.cancel_capture()
+        self.stop_live()
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        self._camera.release()
+
+    def start_live(self, callback, on_frame=None, **kwargs):
+        '''Starts live recognition, the new frames of the capture thread are read and fed to the model on a thread of its own
+
+        Live mode never waits for the model, it is refused until the model is loaded.
+
+        Args:
+            callback (callable): see LiveRecognizer
+            on_frame (callable): called from the live feed thread with every new frame, e.g. to emit a queued signal for the preview
+            kwargs: window, min_agreement and every_nth, see LiveRecognizer
+
+        Returns:
+            started (bool): False if the model is not loaded (yet)
+        '''
+        if not self._camera.is_capturing():
+            # a camera without a capture thread would be read by the feed and the inference worker at once
+            raise RuntimeError("Live mode needs a threaded camera, e.g. Camera(threaded=True)")
+        self.stop_live()
+        if not self.is_ready():
+            return False
+        self._live = LiveRecognizer(self._model, callback, model_lock=self._model_lock, **kwargs)
+        self._live.start()
+        self._live_feed = threading.Thread(target=self._feed_live, args=(self._live, on_frame), name="live-feed", daemon=True)
+        self._live_feed.start()
+        return True
+
+    def _feed_live(self, live, on_frame):
+        # runs on the live feed thread until live mode is stopped, every new frame is previewed and submitted
+        while self._live is live and self._camera.is_capturing():
+            frame = self._camera.read_frame(wait_new=True)
+            if frame is None or self._live is not live:
+                continue
+            live.submit_frame(frame)
+            if on_frame != None:
+                on_frame(frame)
+
+    def stop_live(self):
+        live, self._live = self._live, None
+        if live != None:
+            live.stop()
+            if self._live_feed != None:
+                self._live_feed.join(timeout=2)
+                self._live_feed = None
+            logger.info(f'Live recognition stopped: {live.stats()}')
+
+    def reset_live(self):
+        # forget the smoothing window, e.g. when a new letter is prompted
+        if self._live != None:
+            self._live.reset()
+
+    def live_stats(self):
+        return self._live.stats() if self._live != None else None
+
+    def get_last_frame(self):
+        # latest captured RGB frame, used for the lesson preview
+        return self._camera._new_image
+
+class LiveRecognizer:
+    '''Functionalities of this class:
+    - Runs the model on a live stream of frames on its own thread
+    - Only ever keeps the newest unprocessed frame, older ones are dropped when the model falls behind
+    - Smooths predictions by majority vote over a sliding window and accepts a letter once it is held stably
+
+    Attributes:
+    _model (Model): model used for the predictions
+    _on_result (callable): called from the worker thread with (letter, agreement, accepted) after every prediction
+    _window (deque): latest predicted letters
+    _min_agreement (float): share of the full window that must agree before a letter is accepted
+    _every_nth (int): only every nth frame is submitted to the model
+    _slot (tuple): (timestamp, frame) waiting for the model, None when the worker is idle
+    _condition (Condition): guards the slot, window and counters
+    _latencies (deque): latest frame-to-prediction latencies in seconds
+    _model_lock (Lock): held for every prediction, shared with other users of the model
+    '''
+    def __init__(self, model, on_result, window=8, min_agreement=0.75, every_nth=2, model_lock=None):
+        self._model = model
+        self._model_lock = model_lock if model_lock != None else threading.Lock()
+        self._on_result = on_result
+        self._window = deque(maxlen=window)
+        self._min_agreement = min_agreement
+        self._every_nth = max(1, every_nth)
+        self._slot = None
+        self._condition = threading.Condition()
+        self._running = False
+        self._thread = None
+        self._frames_seen = 0
+        self._frames_submitted = 0
+        self._frames_dropped = 0
+        self._frames_processed = 0
+        self._latencies = deque(maxlen=100)
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="live-recognition", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        with self._condition:
+            self._running = False
+            self._condition.notify()
+        if self._thread != None:
+            self._thread.join(timeout=5)
+
+    def reset(self):
+        with self._condition:
+            self._window.clear()
+            self._slot = None
+
+    def submit_frame(self, frame, timestamp=None):
+        # newest frame wins: a frame still waiting for the model is replaced and counted as dropped
+        self._frames_seen += 1
+        if self._frames_seen % self._every_nth:
+            return False
+        with self._condition:
+            if self._slot != None:
+                self._frames_dropped += 1
+            self._slot = (timestamp if timestamp != None else time.perf_counter(), frame)
+            self._frames_submitted += 1
+            self._condition.notify()
+        return True
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while self._running and self._slot == None:
+                    self._condition.wait()
+                if not self._running:
+                    return
+                timestamp, frame = self._slot
+                self._slot = None
+            with PROFILER.section(), self._model_lock:
+                prediction = self._model.make_prediction(frame)
+            if prediction == None:
+                continue
+            letter = prediction[0]
+            with self._condition:
+                self._frames_processed += 1
+                self._latencies.append(time.perf_counter() - timestamp)
+                self._window.append(letter)
+                letter, votes = Counter(self._window).most_common(1)[0]
+                agreement = votes / self._window.maxlen
+                accepted = agreement >= self._min_agreement
+                if accepted:
+                    # start over so the same hold is not accepted twice
+                    self._window.clear()
+            self._on_result(letter, agreement, accepted)
+
+    def stats(self):
+        # frame counters and latency from frame submission to prediction, in milliseconds
+        with self._condition:
+            latencies = sorted(self._latencies)
+            return {'frames_seen': self._frames_seen, 'frames_submitted': self._frames_submitted,
+                    'frames_dropped': self._frames_dropped, 'frames_processed': self._frames_processed,
+                    'latency_mean_ms': 1000 * float(np.mean(latencies)) if latencies else None,
+                    'latency_max_ms': 1000 * latencies[-1] if latencies else None}
 
 class UserController:
     '''Functionalities of this class:
     - Create, manage, save, and load user database
+    - Share the database with other application processes without losing their updates
+    - Stream users to and from JSONL/CSV files for bulk transfer between sites
+    - Be used from several threads at once: updates of one user are serialized by a per-user lock, and cached
+      profiles are copy-on-write, so snapshot() readers need no lock and never see a half-updated profile
 
     Attributes:
-    _db (PickleDatabase): user information database, stores User objects
-    _active_users: dictionary of active user profiles from database
+    _db (Database): user information database; JournaledPickleDatabase appends per-user changes,
+        SqliteDatabase reads and writes single rows, RecordDatabase single fixed-size records (one process only),
+        any of them can be wrapped in a WriteBehindDatabase
+    _active_users (OrderedDict): user profiles; all users for pickle databases, otherwise the most recently
+        used ones, least recently used first
+    _preloaded (bool): whether _active_users holds every user, otherwise missing users are looked up in _db
+    _cache_size (int): maximum number of profiles kept in _active_users when users are loaded on demand
+    _dirty (set): names of cached users changed since they were last written to _db
+    _lock (RLock): guards _active_users, _dirty and _user_locks, never held during database calls
+    _user_locks (WeakValueDictionary): name -> Lock serializing the updates of that user, dropped once no thread uses it
     '''
-    def __init__(self, user_db: str):
-        self._db = PickleDatabase(user_db)
-        self._active_users = self._db.load_db()
+    # 'journal' keeps every user in memory, 'sqlite' and 'records' load users on demand
+    BACKENDS = ('journal', 'sqlite', 'records')
+
+    def __init__(self, user_db: str, backend='journal', cache_size=256, write_behind=False):
+        self._cache_size = cache_size
+        self._dirty = set()
+        self._lock = threading.RLock()
+        self._user_locks = weakref.WeakValueDictionary()
+        if backend not in self.BACKENDS:
+            raise ValueError(f"Unknown user database backend {backend}, expected one of {self.BACKENDS}")
+        if backend == 'journal':
+            # the pickle file can only be read as a whole
+            self._db = JournaledPickleDatabase(user_db)
+            self._active_users = OrderedDict(self._db.load_db())
+            self._preloaded = True
+        else:
+            db_class, suffix = (SqliteDatabase, ".db") if backend == 'sqlite' else (RecordDatabase, ".usr")
+            if not Path(f"{user_db}{suffix}").exists() and (
+                    Path(f"{user_db}.pkl").exists() or Path(f"{user_db}.pkl.journal").exists()):
+                # first start on this backend, carry over the users of the pickle database; they are imported into
+                # a side file that is only moved into place once complete, so a failed import is retried next start
+                staging = db_class(f"{user_db}.migrating")
+                try:
+                    staging.save_db(JournaledPickleDatabase(user_db).load_db())
+                finally:
+                    staging.close()
+                os.replace(staging.db_name, f"{user_db}{suffix}")
+            self._db = db_class(user_db)
+            # users are loaded on demand, so startup and memory stay flat as the database grows
+            self._active_users = OrderedDict()
+            self._preloaded = False
+        if write_behind:
+            # saves return immediately and are written from a background thread
+            self._db = WriteBehindDatabase(self._db)
 
     def load_user_database(self) -> dict: #NOTE not used, but could be for later other database loading purposes
-        self._active_users = self._db.load_db()
+        self.flush()
+        users = OrderedDict(self._db.load_db()) if self._preloaded else OrderedDict()
+        with self._lock:
+            self._active_users = users
+
+    def _user_lock(self, name):
+        # the caller's reference keeps the lock alive, so memory does not grow with the number of users ever updated
+        with self._lock:
+            return self._user_locks.setdefault(name, threading.Lock())
+
+    def sync(self):
+        # pick up the profiles other processes changed, only those are reloaded
+        changes = self._db.take_changes()
+        with self._lock:
+            for name, user in changes.items():
+                if name in self._dirty:
+                    continue
+                if user == None:
+                    self._active_users.pop(name, None)
+                elif self._preloaded or name in self._active_users:
+                    self._active_users[name] = user
+
+    def user_exists(self, name):
+        # one indexed lookup for SQLite, a dictionary lookup otherwise
+        self.sync()
+        return name in self._active_users or (not self._preloaded and self._db.has_user(name))
+
+    def find_user(self, name):
+        # user profile by name, loaded from the database on first use; None if there is no such user
+        self.sync()
+        with self._lock:
+            user = self._active_users.get(name)
+            if user != None:
+                self._active_users.move_to_end(name)
+                return user
+        if self._preloaded:
+            return None
+        # read outside the lock, so a slow lookup does not hold up other users
+        user = self._db.get_user(name)
+        if user != None:
+            with self._lock:
+                # another thread may have loaded or updated the user meanwhile, its version wins
+                user = self._active_users.get(name, user)
+            self._cache_user(name, user)
+        return user
+
+    def snapshot(self, name):
+        '''Consistent read-only view of a user profile, meant for display
+
+        Cached profiles are never changed after they are published, so readers take no lock;
+        the returned profile must not be modified. Returns None if there is no such user.
+        '''
+        # a single dictionary lookup is atomic, the cache only has to be locked to load a missing user
+        user = self._active_users.get(name)
+        return user if user != None else self.find_user(name)
+
+    def _cache_user(self, name, user):
+        with self._lock:
+            self._active_users[name] = user
+            self._active_users.move_to_end(name)
+            if self._preloaded:
+                return
+            # evict least recently used profiles, the ones with unsaved changes are written back below
+            evicted = []
+            while len(self._active_users) > self._cache_size:
+                old_name, old_user = self._active_users.popitem(last=False)
+                if old_name in self._dirty:
+                    self._dirty.discard(old_name)
+                    evicted.append((old_name, old_user))
+        for old_name, old_user in evicted:
+            self._db.put_user(old_name, old_user, self._active_users)
+
+    def _write_user(self, name, user):
+        self._db.put_user(name, user, self._active_users)
+        with self._lock:
+            self._dirty.discard(name)
+
+    def flush(self):
+        # write back every cached profile with unsaved changes
+        with self._lock:
+            dirty = list(self._dirty)
+        for name in dirty:
+            # no update of this user can be halfway done while it is written
+            with self._user_lock(name):
+                with self._lock:
+                    user = self._active_users.get(name)
+                    self._dirty.discard(name)
+                if user != None:
+                    self._db.put_user(name, user, self._active_users)
+
+    def close(self, timeout=None):
+        # write everything still pending, e.g. before the application exits; returns False if that timed out
+        self.flush()
+        if isinstance(self._db, WriteBehindDatabase):
+            return self._db.close(timeout)
+        self._db.close()
+        return True
 
     def create_user(self, name, proficiency):
         # ensure user does not already exist and save user to database
-        if name not in self._active_users:
+        if not self.user_exists(name):
             new_user = User(name, proficiency)
-            self._active_users[name] = new_user
-            # save database right away
-            self.save_user_database()
-            for user in self._active_users: #for debugging
-                print(f"User: {user}")
+            self._cache_user(name, new_user)
+            # save user right away
+            self._write_user(name, new_user)
+            logger.info(f"Created user: {name}")
             return new_user
         else:
             logger.error("Error! User already exists.")
             return None
 
     def delete_user(self, user):
-        if user._name in self._active_users:
-            self._active_users.pop(user._name)
-            self.save_user_database()
+        if self.user_exists(user._name):
+            with self._user_lock(user._name):
+                with self._lock:
+                    self._active_users.pop(user._name, None)
+                    self._dirty.discard(user._name)
+                self._db.remove_user(user._name, self._active_users)
         else:
             raise Exception("Cannot delete! User not found")
         
     def update_score(self, user, new_scores, alpha=0.2, max_storage=50):
-        # append latest result to score history for each letter
-        for letter, result in enumerate(new_scores):
-            user._score_history[letter].append(result)
-            # ensure only latest 50 attempts are being stored
-            if len(user._score_history[letter]) > max_storage:
-                user._score_history[letter] = user._score_history[letter][-max_storage:]
-
-        # calculate the new weighted and percent score for each letter
-        for letter, _ in enumerate(user._w_let_scores):
-            score, weighted_sum = 0, 0
-            for j, result in enumerate(reversed(user._score_history[letter])):
-                # weight decays as j increases
-                weight = (1-alpha) ** j 
-                score += weight * (1 if result else -1)
-                weighted_sum += weight
-
-            # weighted sum is zero when there is no history for a letter yet, so we need to prevent division by zero
-            if weighted_sum > 0:
-                # weighted scores are from -1 to 1 while percent scores are from 0 to 100
-                user._w_let_scores[letter] = score / weighted_sum
-                user._p_let_scores[letter] = ((user._w_let_scores[letter] + 1) / 2) * 100
-            else:
-                # Default values when there's no score history for a letter yet
-                user._w_let_scores[letter] = 0  
-                user._p_let_scores[letter] = 0  
-        
-        # calculate the overall user score as equally weighted average of letter scores
-        user._overall_score = np.mean(user._p_let_scores)
+        '''Scores a lesson on a copy of the user's profile and publishes the copy, like update_user
 
-    def update_user(self, name, new_scores):
+        Published profiles are never changed, so snapshot() readers keep consistent score arrays meanwhile.
+        The change is written back by flush or on eviction from the cache.
+
+        Returns:
+            user (User): the new published profile, the one passed in is left unchanged
+        '''
+        with self._user_lock(user._name):
+            with self._lock:
+                # the latest published version, the caller's may be older
+                current = self._active_users.get(user._name, user)
+            scored = current.copy()
+            self._score_lesson(scored, new_scores, alpha, max_storage)
+            with self._lock:
+                self._dirty.add(user._name)
+            self._cache_user(user._name, scored)
+        return scored
+
+    def _score_lesson(self, user, new_scores, alpha=0.2, max_storage=50):
+        with span("scoring.update_score"):
+            # record the latest result for each letter, only the letters that changed are rescored
+            for letter, result in enumerate(new_scores):
+                self.record_attempt(user, letter, result, alpha, max_storage)
+
+            # calculate the overall user score as equally weighted average of letter scores
+            user._overall_score = float(np.mean(user._p_let_scores, dtype=np.float64))
+
+    def _apply_lesson(self, user, new_scores):
         # update score before proficiency, as proficiency is based off score
-        if name in self._active_users:
-            self.update_score(self._active_users[name], new_scores)
-            self._active_users[name].update_proficiency()
-            self.save_user_database()
+        self._score_lesson(user, new_scores)
+        user.update_proficiency()
+
+    def record_attempt(self, user, letter, result, alpha=0.2, max_storage=50):
+        '''Appends one attempt to a letter's score history and rescores only that letter
+
+        The letter's weighted score sum(w**j * (+1/-1)) and weight sum(w**j), with j = 0 for the latest attempt
+        and w = 1 - alpha, are summed from its packed history in the same order as the original nested-loop
+        formula, so the scores are bit-identical to it. A running update (scaling the sums by w and subtracting
+        attempts that leave the window) would be O(1), but drifts from that formula by rounding.
+
+        Args:
+            user (User): user whose scores are updated
+            letter (int): letter index, 0 = a
+            result (int): 1 = correct, 0 = incorrect
+        '''
+        if user._score_params != (alpha, max_storage):
+            # old profiles, or scored with other parameters
+            self.recompute_scores(user, alpha, max_storage)
+        # ensure only latest 50 attempts are being stored
+        user.push_result(letter, result, max_storage)
+        self._set_letter_score(user, letter, alpha, max_storage)
+
+    @staticmethod
+    def _letter_sums(bits, length, alpha, max_storage=50):
+        # weighted score and weight sums of one packed history, latest attempt (bit 0) first, as the original formula;
+        # weight * (+1/-1) is exactly +/-weight
+        score, weighted_sum = 0.0, 0.0
+        for j, weight in enumerate(decay_weights(alpha, max_storage)[:length]):
+            score += weight if (bits >> j) & 1 else -weight
+            weighted_sum += weight
+        return score, weighted_sum
+
+    @classmethod
+    def _set_letter_score(cls, user, letter, alpha=0.2, max_storage=50):
+        score, weighted_sum = cls._letter_sums(int(user._history_bits[letter]), int(user._history_len[letter]), alpha, max_storage)
+        # weighted sum is zero when there is no history for a letter yet, so we need to prevent division by zero
+        if weighted_sum > 0 and user._history_len[letter]:
+            # weighted scores are from -1 to 1 while percent scores are from 0 to 100
+            user._w_let_scores[letter] = score / weighted_sum
+            user._p_let_scores[letter] = ((score / weighted_sum + 1) / 2) * 100
         else:
-            raise Exception("Cannot update! User not found")
+            # Default values when there's no score history for a letter yet
+            user._w_let_scores[letter] = 0
+            user._p_let_scores[letter] = 0
+
+    # scores of any number of histories at once, exactly as _letter_sums scores one, see user_profile.score_sums
+    vectorized_scores = staticmethod(score_sums)
+
+    def recompute_scores(self, user, alpha=0.2, max_storage=50):
+        # rebuild all letter scores from the score history at once, e.g. for migration or new parameters
+        user._history_bits &= np.uint64((1 << max_storage) - 1)
+        np.minimum(user._history_len, max_storage, out=user._history_len)
+        scores, weights = self.vectorized_scores(user._history_bits, user._history_len, alpha, max_storage)
+        user._w_let_scores, user._p_let_scores, overall_score = letter_scores(scores, weights, user._history_len)
+        user._overall_score = float(overall_score)
+        user._score_params = (alpha, max_storage)
+
+    def verify_scores(self, user, alpha=0.2, max_storage=50, tolerance=0.0):
+        # check the incrementally maintained letter scores against a full vectorized recompute, exactly by default
+        scores, weights = self.vectorized_scores(user._history_bits, user._history_len, alpha, max_storage)
+        expected = np.divide(scores, weights, out=np.zeros_like(scores), where=(weights > 0) & (user._history_len > 0))
+        return bool(np.allclose(user._w_let_scores, expected.astype(np.float32), rtol=0, atol=tolerance))
+
+    def update_user(self, name, new_scores):
+        # updates of one user are applied one at a time, other users are not blocked
+        with span("user.update_user"), self._user_lock(name):
+            stored_base = self.find_user(name)
+            if stored_base == None:
+                raise Exception("Cannot update! User not found")
+            # score a copy and publish it in one step, readers keep a consistent snapshot meanwhile
+            user = stored_base.copy()
+            self._apply_lesson(user, new_scores)
+            self._cache_user(name, user)
+            # only this user is written, independent of how many users exist; the lesson is applied again to the
+            # latest stored version, so lessons other processes recorded for this user meanwhile are kept
+            stored = self._db.modify_user(name, lambda stored_user: self._apply_lesson(stored_user, new_scores), stored_base)
+            with self._lock:
+                if stored != None and stored is not stored_base:
+                    self._active_users[name] = stored
+                self._dirty.discard(name)
     
     def get_user(self, user):
-        return self._active_users.get(user._name)
+        return self.find_user(user._name)
     
     def save_user_database(self):
-        if not self._active_users:
-            raise Exception("No users to save.")
-        self._db.save_db(self._active_users)
\ No newline at end of file
+        if not self._preloaded:
+            # the cache only holds some of the users, a full save would drop the others
+            self.flush()
+            return
+        with self._lock:
+            if not self._active_users:
+                raise Exception("No users to save.")
+            users = dict(self._active_users)
+            self._dirty.clear()
+        self._db.save_db(users)
+
+    # transfer file columns after name and proficiency: the history of each letter as a string of 1 (correct)
+    # and 0 (incorrect), oldest first; scores are not transferred, they are recomputed on import
+    TRANSFER_FORMATS = ('jsonl', 'csv')
+
+    @classmethod
+    def _transfer_format(cls, path, fmt):
+        fmt = fmt or Path(path).suffix.lstrip('.').lower()
+        if fmt not in cls.TRANSFER_FORMATS:
+            raise ValueError(f"Unknown transfer format '{fmt}', expected one of {cls.TRANSFER_FORMATS}")
+        return fmt
+
+    def export_users(self, path, fmt=None):
+        '''Writes every user to a JSONL or CSV file, one user at a time
+
+        Args:
+            path (string): file to write
+            fmt (string): 'jsonl' or 'csv', taken from the file extension by default
+
+        Returns:
+            count (int): number of users exported
+        '''
+        fmt = self._transfer_format(path, fmt)
+        # unsaved changes are part of the export
+        self.flush()
+        count = 0
+        with open(path, 'w', newline='', encoding='utf-8') as f:
+            if fmt == 'csv':
+                writer = csv.writer(f)
+                writer.writerow(['name', 'proficiency', *ascii_lowercase])
+            for name, user in self._db.iter_users():
+                history = [format(int(bits), f'0{length}b') if length else ''
+                           for bits, length in zip(user._history_bits, user._history_len)]
+                if fmt == 'csv':
+                    writer.writerow([name, user._proficiency, *history])
+                else:
+                    f.write(json.dumps({'name': name, 'proficiency': user._proficiency, 'history': history}) + '\n')
+                count += 1
+        logger.info(f"Exported {count} users to {path}")
+        return count
+
+    def _read_transfer_file(self, f, fmt):
+        # (name, proficiency, history) per user, proficiency is None when the file has none
+        if fmt == 'csv':
+            for row in csv.DictReader(f):
+                yield row['name'], row.get('proficiency') or None, [row.get(letter) or '' for letter in ascii_lowercase]
+        else:
+            for line in f:
+                if line.strip():
+                    record = json.loads(line)
+                    yield record['name'], record.get('proficiency'), record.get('history', [])
+
+    def import_users(self, path, fmt=None, batch_size=1000, alpha=0.2, max_storage=50):
+        '''Adds or replaces users from a JSONL or CSV file written by export_users
+
+        Users are read, scored and written batch_size at a time, so memory does not grow with the number of users
+        (except for the journal backend, which keeps every user in memory anyway).
+
+        Args:
+            path (string): file to read
+            fmt (string): 'jsonl' or 'csv', taken from the file extension by default
+            batch_size (int): users scored and written together
+
+        Returns:
+            count (int): number of users imported
+        '''
+        fmt = self._transfer_format(path, fmt)
+        count = 0
+        with open(path, newline='', encoding='utf-8') as f:
+            batch = []
+            for record in self._read_transfer_file(f, fmt):
+                batch.append(record)
+                if len(batch) == batch_size:
+                    count += self._import_batch(batch, alpha, max_storage)
+                    batch = []
+            if batch:
+                count += self._import_batch(batch, alpha, max_storage)
+        logger.info(f"Imported {count} users from {path}")
+        return count
+
+    def _import_batch(self, batch, alpha, max_storage):
+        letters = len(ascii_lowercase)
+        history_bits = np.zeros((len(batch), letters), dtype=np.uint64)
+        history_len = np.zeros((len(batch), letters), dtype=np.uint8)
+        for i, (name, _, history) in enumerate(batch):
+            if len(history) != letters:
+                raise ValueError(f"User {name} has a history for {len(history)} letters, expected {letters}")
+            for letter, results in enumerate(history):
+                # only the latest max_storage results are kept; the newest result is the lowest bit
+                results = results[-max_storage:]
+                history_bits[i, letter] = int(results, 2) if results else 0
+                history_len[i, letter] = len(results)
+        # score the whole batch at once, the same way recompute_scores does for a single user
+        scores, weights = self.vectorized_scores(history_bits, history_len, alpha, max_storage)
+        w_let_scores, p_let_scores, overall_scores = letter_scores(scores, weights, history_len)
+
+        users = []
+        for i, (name, proficiency, _) in enumerate(batch):
+            user = User(name, proficiency)
+            user._history_bits = history_bits[i]
+            user._history_len = history_len[i]
+            user._w_let_scores = w_let_scores[i]
+            user._p_let_scores = p_let_scores[i]
+            user._score_params = (alpha, max_storage)
+            user._overall_score = float(overall_scores[i])
+            if proficiency is None:
+                user.update_proficiency()
+            users.append((name, user))
+        self._db.put_users(users)
+        with self._lock:
+            for name, user in users:
+                self._dirty.discard(name)
+                if self._preloaded or name in self._active_users:
+                    self._active_users[name] = user
+        return len(users)
\ No newline at end of file
@@ -0,0 +1,49 @@
+'''File name: import_budget.py
+Contributers: Zoe Takacs and Wyatt Shaw
+Info: Checks that importing the application modules stays fast and does not pull in the model dependencies
+Note: NOT used to run the application; exits with status 1 when the budget is exceeded
+'''
+import os
+import subprocess
+import sys
+
+# modules that must only be imported once a Model or Camera is constructed
+HEAVY_MODULES = ('torch', 'fastai', 'cv2', 'matplotlib', 'pandas', 'onnxruntime')
+# modules whose import is checked; application.py starts the GUI on import so its controllers are checked instead
+CHECKED_MODULES = ('controller_classes', 'base_classes', 'user_database', 'user_profile', 'metrics', 'profiling')
+# total import time allowed per checked module, in microseconds
+BUDGET_US = int(os.getenv("IMPORT_BUDGET_US", 500000))
+
+def measure_imports(module):
+    # run a fresh interpreter with -X importtime and return {imported module: self time in us}
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                            capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+    if result.returncode != 0:
+        raise RuntimeError(f"Importing {module} failed:\n{result.stderr}")
+    times = {}
+    for line in result.stderr.splitlines():
+        # lines look like "import time:       123 |        456 |   package.module"
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, _, name = line[len("import time:"):].split("|")
+        times[name.strip()] = int(self_us)
+    return times
+
+def check_budget(budget_us=BUDGET_US):
+    failures = []
+    for module in CHECKED_MODULES:
+        times = measure_imports(module)
+        total = sum(times.values())
+        heavy = sorted({name.split(".")[0] for name in times} & set(HEAVY_MODULES))
+        print(f"{module}: {total / 1000:.1f} ms, {len(times)} modules imported")
+        if heavy:
+            failures.append(f"{module} imports {', '.join(heavy)} at startup")
+        if total > budget_us:
+            failures.append(f"{module} takes {total / 1000:.1f} ms to import, budget is {budget_us / 1000:.1f} ms")
+    return failures
+
+if __name__ == "__main__":
+    failures = check_budget()
+    for failure in failures:
+        print(f"Error! {failure}")
+    sys.exit(1 if failures else 0)
@@ -0,0 +1,274 @@
+'''File name: load_simulator.py
+Contributers: Zoe Takacs and Wyatt Shaw
+Info: Headless load generator, many virtual learners take lessons concurrently through SessionController and UserController
+Note: NOT used to run the application; e.g. python load_simulator.py --learners 32 --lessons 3 --output load.json
+      reports throughput and tail latency per stage, runs on replayed or synthetic frames and (by default) a synthetic model
+'''
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from string import ascii_lowercase
+
+import numpy as np
+
+from base_classes import Camera, ImageDirectorySource, Model, SyntheticSource, VideoFileSource
+from controller_classes import SessionController, UserController
+from metrics import REGISTRY
+
+# letters of a lesson, as in Lesson1
+LESSON_LETTERS = 'abcde'
+STAGES = ('prompt', 'capture', 'model_wait', 'predict', 'capture_predict', 'record', 'save')
+
+class StageStats:
+    '''Functionalities of this class:
+    - collect the duration of every pass through each stage, from any thread
+    - summarize them as throughput and latency percentiles
+
+    Attributes:
+    - _durations (defaultdict): stage -> list of durations in seconds
+    - _lock (Lock): guards _durations
+    '''
+    def __init__(self):
+        self._durations = defaultdict(list)
+        self._lock = threading.Lock()
+
+    def add(self, stage, seconds):
+        with self._lock:
+            self._durations[stage].append(seconds)
+
+    @contextmanager
+    def time(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - start)
+
+    def summary(self, wall_time):
+        with self._lock:
+            durations = {stage: np.asarray(values) for stage, values in self._durations.items()}
+        summary = {}
+        for stage in [*STAGES, *sorted(set(durations) - set(STAGES))]:
+            values = durations.get(stage)
+            if values is None or not values.size:
+                continue
+            p50, p95, p99 = np.percentile(values, [50, 95, 99])
+            summary[stage] = {'count': int(values.size), 'throughput_per_s': values.size / wall_time,
+                              'mean': float(values.mean()), 'p50': float(p50), 'p95': float(p95),
+                              'p99': float(p99), 'max': float(values.max())}
+        return summary
+
+class TimedCamera(Camera):
+    # Camera recording how long each capture takes, including the wait for the next frame of its source
+    def __init__(self, stats, **kwargs):
+        self.stats = stats
+        super().__init__(**kwargs)
+
+    def take_image(self, save=False, img_path="new_image.png"):
+        with self.stats.time('capture'):
+            return super().take_image(save, img_path)
+
+def make_source(args, index):
+    # one source per learner, each replays on its own clock
+    if args.source == 'video':
+        return VideoFileSource(args.source_path, fps=args.fps)
+    if args.source == 'directory':
+        return ImageDirectorySource(args.source_path, fps=args.fps, cache=True)
+    return SyntheticSource(fps=args.fps, seed=args.seed + index, capture_delay=args.capture_ms / 1000)
+
+class SyntheticModel:
+    '''Functionalities of this class:
+    - stand in for Model when no model file is available, taking predict_delay per prediction
+    - recognize the letter of a SyntheticSource frame correctly with probability accuracy; frames of other sources
+      carry no letter, so their predictions are arbitrary
+
+    The delay is a sleep, which like a forward pass in torch lets other threads run meanwhile.
+    '''
+    def __init__(self, predict_delay=0.03, accuracy=0.8, seed=0):
+        self.predict_delay = predict_delay
+        self.accuracy = accuracy
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def is_loaded(self):
+        return True
+
+    def make_prediction(self, img_path):
+        time.sleep(self.predict_delay)
+        with self._lock:
+            correct = self._random.random() < self.accuracy
+            index = int(img_path[0, 0, 0]) % len(ascii_lowercase) if correct else self._random.randrange(len(ascii_lowercase))
+        probability = np.full(len(ascii_lowercase), 0.01, dtype=np.float32)
+        probability[index] = 1 - 0.01 * (len(ascii_lowercase) - 1)
+        return ascii_lowercase[index], probability
+
+class SharedModel:
+    '''Functionalities of this class:
+    - share one loaded model between the sessions of all virtual learners
+    - let at most slots predictions run at once, like a box with limited inference capacity
+
+    The fastai Learner is not thread-safe, so slots should stay 1 unless the model runs on the fast path or ONNX.
+    '''
+    def __init__(self, model, stats, slots=1):
+        self.model = model
+        self.stats = stats
+        self._slots = threading.BoundedSemaphore(slots)
+
+    def is_loaded(self):
+        return self.model.is_loaded()
+
+    def make_prediction(self, img_path):
+        with self.stats.time('model_wait'):
+            self._slots.acquire()
+        try:
+            with self.stats.time('predict'):
+                return self.model.make_prediction(img_path)
+        finally:
+            self._slots.release()
+
+def run_learner(index, session, source, user_controller, stats, args, errors):
+    # one virtual learner taking lessons the way Lesson1 drives the controllers
+    rng = random.Random(args.seed + index)
+    name = f"learner{index}"
+    try:
+        for _ in range(args.lessons):
+            letters = list(LESSON_LETTERS)
+            rng.shuffle(letters)
+            score = []
+            for prompt in letters:
+                with stats.time('prompt'):
+                    # the virtual learner signs the prompted letter, a video plays on regardless
+                    if hasattr(source, 'show'):
+                        try:
+                            source.show(prompt)
+                        except ValueError:
+                            # the dataset has no images of this letter
+                            source.show(None)
+                if args.think_ms:
+                    time.sleep(rng.uniform(0.5, 1.5) * args.think_ms / 1000)
+                with stats.time('capture_predict'):
+                    letter, _, _ = session.capture_and_predict_async().result()
+                with stats.time('record'):
+                    score.append(1 if prompt == letter else 0)
+            with stats.time('save'):
+                user_controller.update_user(name, score)
+            stats.add('lesson', 0.0)
+    except Exception as e:
+        errors.append(f"{name}: {e!r}")
+
+def simulate(args):
+    stats = StageStats()
+    if args.model:
+        model = Model(args.model, fast_path=args.fast_path, backend=args.backend)
+        if not model.is_loaded():
+            raise RuntimeError(f"Model {args.model} could not be loaded")
+    else:
+        model = SyntheticModel(args.predict_ms / 1000, args.accuracy, args.seed)
+    shared_model = SharedModel(model, stats, args.model_slots)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        user_controller = UserController(args.db or os.path.join(tmp_dir, "load_users"), backend=args.db_backend,
+                                         write_behind=args.write_behind)
+        for index in range(args.learners):
+            if not user_controller.user_exists(f"learner{index}"):
+                user_controller.create_user(f"learner{index}", "Beginner")
+        # one session and camera per learner, like one kiosk each; the model and the database are shared
+        sources = [make_source(args, index) for index in range(args.learners)]
+        sessions = [SessionController(camera=TimedCamera(stats, threaded=args.threaded, source=source), model=shared_model)
+                    for source in sources]
+        errors = []
+        learners = [threading.Thread(target=run_learner, name=f"learner{index}",
+                                     args=(index, sessions[index], sources[index], user_controller, stats, args, errors))
+                    for index in range(args.learners)]
+        start = time.perf_counter()
+        for learner in learners:
+            learner.start()
+        for learner in learners:
+            learner.join()
+        wall_time = time.perf_counter() - start
+        for session in sessions:
+            session.shutdown()
+        with stats.time('close'):
+            user_controller.close()
+
+    stages = stats.summary(wall_time)
+    lessons = stages.pop('lesson', {}).get('count', 0)
+    report = {'config': {key: value for key, value in vars(args).items() if key != 'output'},
+              'model': args.model or 'synthetic',
+              'wall_time_s': wall_time,
+              'lessons_completed': lessons,
+              'lessons_per_s': lessons / wall_time,
+              'stages': stages,
+              # spans inside the controllers, camera, model and database, e.g. camera.read or db.sqlite.modify_user
+              'metrics': REGISTRY.snapshot(),
+              'errors': errors}
+    if 'capture_predict' in stages:
+        # a request waits in its session queue and for a model slot besides being captured and predicted
+        service = sum(stages[stage]['mean'] for stage in ('capture', 'predict') if stage in stages)
+        model_wait = stages.get('model_wait', {}).get('mean', 0.0)
+        report['contention'] = {
+            'model_wait_mean_s': model_wait,
+            'model_wait_share': model_wait / stages['capture_predict']['mean'],
+            'other_wait_mean_s': max(0.0, stages['capture_predict']['mean'] - service - model_wait)}
+    return report
+
+def print_summary(report, file=sys.stderr):
+    print(f"{report['config']['learners']} learners, {report['lessons_completed']} lessons in "
+          f"{report['wall_time_s']:.2f}s ({report['lessons_per_s']:.2f} lessons/s), model: {report['model']}", file=file)
+    print(f"{'stage':<16}{'count':>8}{'per s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}", file=file)
+    for stage, summary in report['stages'].items():
+        print(f"{stage:<16}{summary['count']:>8}{summary['throughput_per_s']:>10.1f}{summary['p50'] * 1000:>10.2f}"
+              f"{summary['p95'] * 1000:>10.2f}{summary['p99'] * 1000:>10.2f}{summary['max'] * 1000:>10.2f}", file=file)
+    if 'contention' in report:
+        contention = report['contention']
+        print(f"model slot wait is {contention['model_wait_share']:.0%} of capture+predict latency, "
+              f"{contention['other_wait_mean_s'] * 1000:.2f} ms other queueing per request", file=file)
+    for error in report['errors']:
+        print(f"Error! {error}", file=file)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Headless load simulator for concurrent virtual learners")
+    parser.add_argument("--learners", type=int, default=16)
+    parser.add_argument("--lessons", type=int, default=3, help="lessons per learner")
+    parser.add_argument("--think-ms", type=float, default=0.0, help="average pause before each capture")
+    parser.add_argument("--source", default="synthetic", choices=("synthetic", "directory", "video"),
+                        help="frames each learner's camera replays")
+    parser.add_argument("--source-path", help="create_photos.py image directory or video file")
+    parser.add_argument("--fps", type=float, default=30.0, help="frame rate the source is replayed at, 0 for unpaced")
+    parser.add_argument("--capture-ms", type=float, default=0.0,
+                        help="time each synthetic capture takes on top of waiting for the next frame")
+    parser.add_argument("--threaded", action="store_true", help="capture continuously like the application does")
+    parser.add_argument("--model", help="model file, a synthetic model is used when omitted")
+    parser.add_argument("--backend", default="fastai", choices=Model.BACKENDS)
+    parser.add_argument("--fast-path", action="store_true")
+    parser.add_argument("--model-slots", type=int, default=1, help="predictions that may run at the same time")
+    parser.add_argument("--predict-ms", type=float, default=30.0, help="time a synthetic prediction takes")
+    parser.add_argument("--accuracy", type=float, default=0.8, help="share of correct synthetic predictions")
+    parser.add_argument("--db", help="user database to use, a temporary one by default")
+    parser.add_argument("--db-backend", default="sqlite", choices=UserController.BACKENDS)
+    parser.add_argument("--write-behind", action="store_true")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="JSON report file, printed when omitted")
+    args = parser.parse_args(argv)
+    if args.source != 'synthetic' and not args.source_path:
+        parser.error(f"--source {args.source} needs --source-path")
+
+    report = simulate(args)
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text)
+    else:
+        print(text)
+    print_summary(report)
+    return 1 if report['errors'] else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
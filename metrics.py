@@ -0,0 +1,221 @@
+'''File name: metrics.py
+Contributers: Zoe Takacs and Wyatt Shaw
+Info: In-process metrics registry, counters and latency histograms fed by timing spans around each stage
+Note: set METRICS=0 to turn every span and counter into a no-op
+'''
+from bisect import bisect_right
+import json
+import os
+import threading
+import time
+
+# histogram bucket upper bounds in seconds, four per doubling from 1 us to about 2 minutes
+BUCKET_BOUNDS = tuple(1e-6 * 2 ** (i / 4) for i in range(108))
+
+class Counter:
+    '''Functionalities of this class:
+    - count events, e.g. predictions made, from any thread
+    '''
+    __slots__ = ('value', '_lock')
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+class Histogram:
+    '''Functionalities of this class:
+    - collect durations into fixed logarithmic buckets, so memory stays constant however many are recorded
+    - estimate percentiles from the buckets, within one bucket width (19%)
+
+    Attributes:
+        _counts (list): number of durations per bucket of BUCKET_BOUNDS, the last one for anything longer
+    '''
+    __slots__ = ('count', 'total', 'min', 'max', '_counts', '_lock')
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.count = 0
+            self.total = 0.0
+            self.min = float('inf')
+            self.max = 0.0
+            self._counts = [0] * (len(BUCKET_BOUNDS) + 1)
+
+    def record(self, seconds):
+        bucket = bisect_right(BUCKET_BOUNDS, seconds)
+        with self._lock:
+            self._counts[bucket] += 1
+            self.count += 1
+            self.total += seconds
+            if seconds < self.min:
+                self.min = seconds
+            if seconds > self.max:
+                self.max = seconds
+
+    def percentile(self, q):
+        # upper bound of the bucket holding the q-th percentile, capped at the largest duration seen
+        with self._lock:
+            counts, count, largest = list(self._counts), self.count, self.max
+        if not count:
+            return None
+        rank, seen = q / 100 * count, 0
+        for bucket, bucket_count in enumerate(counts):
+            seen += bucket_count
+            if seen >= rank and bucket_count:
+                return min(BUCKET_BOUNDS[bucket], largest) if bucket < len(BUCKET_BOUNDS) else largest
+        return largest
+
+    def snapshot(self):
+        with self._lock:
+            count, total, smallest, largest = self.count, self.total, self.min, self.max
+        if not count:
+            return {'count': 0}
+        return {'count': count, 'sum': total, 'mean': total / count, 'min': smallest, 'max': largest,
+                'p50': self.percentile(50), 'p95': self.percentile(95), 'p99': self.percentile(99)}
+
+class Span:
+    # times the block it wraps into a histogram; a class with slots costs less than a generator context manager
+    __slots__ = ('histogram', 'start')
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.record(time.perf_counter() - self.start)
+        return False
+
+class _NoSpan:
+    # shared by every span while metrics are disabled
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_NO_SPAN = _NoSpan()
+
+class MetricsRegistry:
+    '''Functionalities of this class:
+    - hold named counters and latency histograms, created on first use
+    - time stages with span(name), e.g. "with REGISTRY.span('camera.read'):"
+    - dump everything to JSON, or serve it on a local HTTP endpoint
+
+    Attributes:
+        enabled (bool): record anything at all, spans and counters are no-ops otherwise
+        _counters (dict): name -> Counter
+        _histograms (dict): name -> Histogram
+        _lock (Lock): guards creating counters and histograms
+        _server (ThreadingHTTPServer): running endpoint, None when not serving
+    '''
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self._counters = {}
+        self._histograms = {}
+        self._lock = threading.Lock()
+        self._server = None
+
+    def counter(self, name):
+        counter = self._counters.get(name)
+        if counter == None:
+            with self._lock:
+                counter = self._counters.setdefault(name, Counter())
+        return counter
+
+    def histogram(self, name):
+        histogram = self._histograms.get(name)
+        if histogram == None:
+            with self._lock:
+                histogram = self._histograms.setdefault(name, Histogram())
+        return histogram
+
+    def span(self, name):
+        if not self.enabled:
+            return _NO_SPAN
+        return Span(self.histogram(name))
+
+    def count(self, name, amount=1):
+        if self.enabled:
+            self.counter(name).inc(amount)
+
+    def reset(self):
+        with self._lock:
+            counters, histograms = list(self._counters.values()), list(self._histograms.values())
+        for counter in counters:
+            with counter._lock:
+                counter.value = 0
+        for histogram in histograms:
+            histogram.reset()
+
+    def snapshot(self):
+        with self._lock:
+            counters, histograms = dict(self._counters), dict(self._histograms)
+        return {'timestamp': time.time(), 'unit': 's',
+                'counters': {name: counter.value for name, counter in sorted(counters.items())},
+                'histograms': {name: histogram.snapshot() for name, histogram in sorted(histograms.items())}}
+
+    def dump_json(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.snapshot(), f, indent=2)
+
+    def serve(self, port=0, host='127.0.0.1'):
+        '''Serves the snapshot as JSON on http://host:port/metrics from a background thread
+
+        Args:
+            port (int): 0 picks a free port, see the returned address
+
+        Returns:
+            address (tuple): (host, port) the endpoint listens on
+        '''
+        if self._server != None:
+            return self._server.server_address
+        # only needed once serving, so importing this module stays cheap
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        registry = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = json.dumps(registry.snapshot(), indent=2).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((host, port), MetricsHandler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, name="metrics-endpoint", daemon=True).start()
+        return self._server.server_address
+
+    def stop_serving(self):
+        if self._server != None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+# registry of the whole process, used through the functions below
+REGISTRY = MetricsRegistry(enabled=os.getenv("METRICS", "1") != "0")
+
+def span(name):
+    return REGISTRY.span(name)
+
+def count(name, amount=1):
+    REGISTRY.count(name, amount)
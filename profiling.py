@@ -0,0 +1,272 @@
+'''File name: profiling.py
+Contributers: Zoe Takacs and Wyatt Shaw
+Info: On-demand profiling of the running application for the next lesson or the next few captures, and event loop stall detection
+Note: start the application with PROFILE=lesson or PROFILE=<captures>, or press Ctrl+Shift+P in it; files go to PROFILE_DIR (profiles)
+      each window writes a cProfile stats file, a collapsed stack file for flamegraph.pl or speedscope and the stalls seen meanwhile
+'''
+from collections import Counter
+from contextlib import contextmanager
+import json
+import os
+import sys
+import threading
+import time
+
+from metrics import REGISTRY
+
+# seconds between stack samples of all threads
+SAMPLE_INTERVAL = 0.005
+# a GUI timer firing this many seconds late means the event loop was blocked
+STALL_THRESHOLD = 0.05
+
+class StallMonitor:
+    '''Functionalities of this class:
+    - detect event loop stalls from a periodic GUI timer, the loop was blocked for as long as a tick comes late
+    - record each stall in the gui.event_loop_stall histogram and hand it to on_stall
+
+    Attributes:
+        interval (float): seconds between ticks of the timer calling tick
+        threshold (float): shortest lateness counted as a stall
+        _on_stall (callable): called with (seconds, perf_counter time the stall ended) for every stall
+        _last (float): perf_counter time of the previous tick, None before the first one
+    '''
+    def __init__(self, interval=0.05, threshold=STALL_THRESHOLD, on_stall=None):
+        self.interval = interval
+        self.threshold = threshold
+        self._on_stall = on_stall
+        self._last = None
+
+    def reset(self):
+        # call when the timer (re)starts, the time it was stopped is no stall
+        self._last = None
+
+    def tick(self, now=None):
+        now = time.perf_counter() if now == None else now
+        last, self._last = self._last, now
+        if last == None:
+            return None
+        stall = now - last - self.interval
+        if stall < self.threshold:
+            return None
+        if REGISTRY.enabled:
+            REGISTRY.histogram("gui.event_loop_stall").record(stall)
+        if self._on_stall != None:
+            self._on_stall(stall, now)
+        return stall
+
+class Profiler:
+    '''Functionalities of this class:
+    - profile the application for a window: the next lesson, or the next captures
+    - deterministic profile (cProfile) of the thread that started the window, and of other threads inside section()
+    - sample the stacks of every thread, including the camera and model threads, for a flamegraph
+    - collect the event loop stalls reported during the window
+
+    The GUI thread arms, polls and stops the profiler; sections and the capture and lesson hooks work from any thread.
+    Threads holding the GIL in native code delay the samples, so such time shows up in the cProfile stats instead.
+    From Python 3.12 on, only one cProfile can be enabled in the whole process: it then covers every thread, and
+    sections of other threads (or the whole window, if another profiler is active) rely on the samples alone.
+
+    Attributes:
+        output_dir (str): directory the files of each window are written to
+        sample_interval (float): seconds between stack samples
+        _state (str): 'idle', 'armed' (waits for the next lesson), 'running' or 'finishing' (waits for poll)
+        _mode: 'lesson' or the number of captures of the window
+        _captures_left (int): captures until the window ends, in captures mode
+        _window (int): id of the current window, sections that outlive their window are dropped
+        _owner (Profile): profile of the thread that started the window, None if cProfile could not be enabled
+        _profiles (list): finished section profiles of other threads
+        _local (local): profile enabled by this thread, sections do not nest
+        _samples (Counter): collapsed stack -> number of samples
+        _stalls (list): (seconds into the window, stall duration)
+        _sampler (Thread): samples the stacks while running
+        _lock (Lock): guards the state, profiles and stalls
+    '''
+    def __init__(self, output_dir="profiles", sample_interval=SAMPLE_INTERVAL):
+        self.output_dir = output_dir
+        self.sample_interval = sample_interval
+        self._state = 'idle'
+        self._mode = None
+        self._captures_left = 0
+        self._window = 0
+        self._owner = None
+        self._profiles = []
+        self._local = threading.local()
+        self._samples = Counter()
+        self._stalls = []
+        self._sampler = None
+        self._stop_sampling = threading.Event()
+        self._started = 0.0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def parse_mode(value):
+        # 'lesson' or a positive number of captures, e.g. from the PROFILE environment variable
+        value = value.strip().lower()
+        if value == 'lesson':
+            return value
+        if value.isdigit() and int(value) > 0:
+            return int(value)
+        raise ValueError(f"Profiling window must be 'lesson' or a number of captures, not {value!r}")
+
+    @property
+    def state(self):
+        return self._state
+
+    def arm(self, mode):
+        '''Profiles the next lesson, from the time it starts, or the next captures, from now on
+
+        Args:
+            mode: 'lesson' or the number of captures, see parse_mode
+        '''
+        if self._state != 'idle':
+            raise RuntimeError(f"Profiler is already {self._state}")
+        self._mode = mode
+        if mode == 'lesson':
+            self._state = 'armed'
+        else:
+            self._captures_left = mode
+            self.start()
+
+    def start(self):
+        import cProfile
+        with self._lock:
+            self._window += 1
+            self._profiles = []
+            self._stalls = []
+            self._samples = Counter()
+            self._started = time.perf_counter()
+            self._state = 'running'
+        self._owner = self._enable(cProfile.Profile())
+        self._local.profile = self._owner
+        self._stop_sampling.clear()
+        self._sampler = threading.Thread(target=self._sample, name="profiler-sampler", daemon=True)
+        self._sampler.start()
+
+    @staticmethod
+    def _enable(profile):
+        # the profile if it could be enabled, None when another profiler already is (Python 3.12+)
+        try:
+            profile.enable()
+        except ValueError:
+            return None
+        return profile
+
+    def _sample(self):
+        own = threading.get_ident()
+        while not self._stop_sampling.wait(self.sample_interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame != None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                stack.append(names.get(ident, f"thread-{ident}"))
+                # root first, frames separated by ';' as flamegraph.pl expects
+                self._samples[";".join(reversed(stack))] += 1
+
+    @contextmanager
+    def section(self):
+        # profiles the block on a thread other than the owner, e.g. a capture on the inference worker
+        if self._state != 'running' or getattr(self._local, 'profile', None) != None:
+            yield
+            return
+        import cProfile
+        window = self._window
+        profile = self._enable(cProfile.Profile())
+        if profile == None:
+            # the process-wide profile of the window already sees this thread, or only the samples do
+            yield
+            return
+        self._local.profile = profile
+        try:
+            yield
+        finally:
+            profile.disable()
+            self._local.profile = None
+            with self._lock:
+                if window == self._window and self._state in ('running', 'finishing'):
+                    self._profiles.append(profile)
+
+    def capture_done(self):
+        if self._state != 'running' or self._mode == 'lesson':
+            return
+        with self._lock:
+            self._captures_left -= 1
+            if self._captures_left <= 0 and self._state == 'running':
+                self._state = 'finishing'
+
+    def lesson_started(self):
+        # called on the GUI thread, starts an armed window
+        if self._state == 'armed':
+            self.start()
+
+    def lesson_done(self):
+        if self._state == 'running' and self._mode == 'lesson':
+            with self._lock:
+                self._state = 'finishing'
+
+    def record_stall(self, seconds, at=None):
+        # usable as the on_stall of a StallMonitor
+        if self._state not in ('running', 'finishing'):
+            return
+        at = time.perf_counter() if at == None else at
+        with self._lock:
+            self._stalls.append((at - seconds - self._started, seconds))
+
+    def poll(self):
+        # called periodically on the thread that started the window, stops it once it is over
+        if self._state == 'finishing':
+            return self.stop()
+        return None
+
+    def stop(self):
+        '''Ends the window early or once it is over and writes its files, on the thread that started it
+
+        Returns:
+            paths (dict): 'profile', 'collapsed' and 'summary' file names, None when nothing was running
+        '''
+        if self._state == 'armed':
+            self._state = 'idle'
+            return None
+        if self._state == 'idle':
+            return None
+        if self._owner != None:
+            self._owner.disable()
+        self._local.profile = None
+        self._stop_sampling.set()
+        self._sampler.join()
+        with self._lock:
+            duration = time.perf_counter() - self._started
+            profiles = [profile for profile in (self._owner, *self._profiles) if profile != None]
+            stalls = list(self._stalls)
+            self._profiles = []
+            self._owner = None
+            self._state = 'idle'
+        return self._write(profiles, stalls, duration)
+
+    def _write(self, profiles, stalls, duration):
+        import pstats
+        os.makedirs(self.output_dir, exist_ok=True)
+        label = 'lesson' if self._mode == 'lesson' else f"{self._mode}_captures"
+        prefix = os.path.join(self.output_dir, f"profile_{time.strftime('%Y%m%d-%H%M%S')}_{label}")
+        paths = {'profile': prefix + ".prof", 'collapsed': prefix + ".collapsed", 'summary': prefix + ".json"}
+        # open with python -m pstats or snakeviz
+        pstats.Stats(*profiles).dump_stats(paths['profile'])
+        with open(paths['collapsed'], 'w') as f:
+            for stack, samples in sorted(self._samples.items()):
+                f.write(f"{stack} {samples}\n")
+        durations = [seconds for _, seconds in stalls]
+        summary = {'window': label, 'duration_s': duration, 'threads_profiled': len(profiles),
+                   'sample_interval_s': self.sample_interval, 'samples': sum(self._samples.values()),
+                   'stalls': {'count': len(stalls), 'total_s': sum(durations), 'max_s': max(durations, default=0.0),
+                              'events': [{'at_s': at, 'duration_s': seconds} for at, seconds in stalls]},
+                   'files': paths}
+        with open(paths['summary'], 'w') as f:
+            json.dump(summary, f, indent=2)
+        return paths
+
+# profiler of the whole process, hooked into the controllers and driven by the application
+PROFILER = Profiler(os.getenv("PROFILE_DIR", "profiles"))
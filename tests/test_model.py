@@ -0,0 +1,36 @@
+'''File name: test_model.py
+Contributers: Zoe Takacs and Wyatt Shaw
+Info: Tests of the Model class, run with python -m pytest
+'''
+from collections import Counter
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+from base_classes import Model
+
+REPO = Path(__file__).resolve().parent.parent
+
+def test_calibration_covers_every_letter_and_is_held_out():
+    # create_photos.py takes hundreds of pictures per letter, listed letter by letter
+    samples = [(f"{letter}/{letter}{i}.jpg", letter) for letter in "abcdefghijklmnopqrstuvwxyz" for i in range(300)]
+    calibration, evaluation = Model.split_calibration(samples, 256)
+
+    assert len(calibration) == 256
+    assert set(Counter(letter for _, letter in calibration).values()) == {9, 10}
+    assert not set(calibration) & set(evaluation) and len(calibration) + len(evaluation) == len(samples)
+    assert set(letter for _, letter in evaluation) == set("abcdefghijklmnopqrstuvwxyz")
+
+def test_fast_path_predicts_like_the_learner():
+    pytest.importorskip("fastai")
+    model_fpath, image = REPO / 'Zoya_Letters_EP10.pkl', str(REPO / 'default_img.png')
+    if not model_fpath.exists():
+        pytest.skip(f"no trained model at {model_fpath}")
+    slow, fast = Model(model_fpath), Model(model_fpath, fast_path=True)
+    assert fast._fast_path
+
+    letter, probability = slow.make_prediction(image)
+    fast_letter, fast_probability = fast.make_prediction(image)
+    assert fast_letter == letter
+    assert np.allclose(np.asarray(fast_probability), np.asarray(probability), atol=1e-5)
@@ -0,0 +1,57 @@
+'''File name: test_profiling.py
+Contributers: Zoe Takacs and Wyatt Shaw
+Info: Tests of the on-demand profiler, run with python -m pytest
+'''
+import cProfile
+import json
+import threading
+
+from profiling import Profiler
+
+class ProcessWideProfile(cProfile.Profile):
+    # cProfile as of Python 3.12: only one profile can be enabled in the whole process
+    active = None
+
+    def enable(self, *args, **kwargs):
+        if ProcessWideProfile.active != None:
+            raise ValueError("Another profiling tool is already active")
+        ProcessWideProfile.active = self
+        super().enable(*args, **kwargs)
+
+    def disable(self):
+        if ProcessWideProfile.active is self:
+            ProcessWideProfile.active = None
+        super().disable()
+
+def run_section(profiler):
+    with profiler.section():
+        sum(range(1000))
+
+def test_sections_fall_back_to_samples_when_cprofile_is_taken(tmp_path, monkeypatch):
+    monkeypatch.setattr(cProfile, "Profile", ProcessWideProfile)
+    profiler = Profiler(str(tmp_path))
+    profiler.arm(1)
+    worker = threading.Thread(target=run_section, args=(profiler,))
+    worker.start()
+    worker.join()
+    profiler.capture_done()
+    paths = profiler.poll()
+
+    with open(paths['summary']) as f:
+        assert json.load(f)['threads_profiled'] == 1
+
+def test_window_runs_on_samples_when_another_profiler_is_active(tmp_path, monkeypatch):
+    monkeypatch.setattr(cProfile, "Profile", ProcessWideProfile)
+    other = ProcessWideProfile()
+    other.enable()
+    try:
+        profiler = Profiler(str(tmp_path))
+        profiler.arm(1)
+        run_section(profiler)
+        profiler.capture_done()
+        paths = profiler.poll()
+    finally:
+        other.disable()
+
+    with open(paths['summary']) as f:
+        assert json.load(f)['threads_profiled'] == 0
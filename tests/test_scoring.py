@@ -0,0 +1,42 @@
+'''File name: test_scoring.py
+Contributers: Zoe Takacs and Wyatt Shaw
+Info: Tests that incremental scoring gives exactly the scores of the original nested-loop formula
+'''
+import numpy as np
+
+from controller_classes import UserController
+from user_profile import User
+
+def original_scores(history, alpha=0.2):
+    # the nested loop UserController.update_score used before scores were kept incrementally
+    score, weighted_sum = 0, 0
+    for j, result in enumerate(reversed(history)):
+        weight = (1-alpha) ** j
+        score += weight * (1 if result else -1)
+        weighted_sum += weight
+    return score, weighted_sum
+
+def test_record_attempt_matches_original_formula_exactly():
+    rng = np.random.default_rng(0)
+    # scoring needs no database
+    scorer = UserController.__new__(UserController)
+    user = User("x", "Beginner")
+    histories = [[] for _ in range(26)]
+    # long enough for attempts to leave the 50 attempt window many times
+    for _ in range(300):
+        lesson = rng.integers(0, 2, size=26).tolist()
+        for letter, result in enumerate(lesson):
+            scorer.record_attempt(user, letter, result)
+            histories[letter] = (histories[letter] + [result])[-50:]
+        for letter, history in enumerate(histories):
+            score, weighted_sum = original_scores(history)
+            assert user._w_let_scores[letter] == np.float32(score / weighted_sum)
+            assert user._p_let_scores[letter] == np.float32(((score / weighted_sum + 1) / 2) * 100)
+
+def test_vectorized_scores_match_original_formula_exactly():
+    rng = np.random.default_rng(1)
+    user = User("x", "Beginner")
+    user._score_history = [rng.integers(0, 2, size=length).tolist() for length in rng.integers(0, 51, size=26)]
+    scores, weights = UserController.vectorized_scores(user._history_bits, user._history_len)
+    for letter, history in enumerate(user._score_history):
+        assert (scores[letter], weights[letter]) == original_scores(history)
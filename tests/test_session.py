@@ -0,0 +1,65 @@
+'''File name: test_session.py
+Contributers: Zoe Takacs and Wyatt Shaw
+Info: Tests of live recognition in the session controller, run with python -m pytest
+'''
+import threading
+import time
+
+import pytest
+
+from base_classes import Camera, SyntheticSource
+from controller_classes import SessionController
+
+class FixedModel:
+    def make_prediction(self, frame):
+        return 'a', None
+
+def test_live_mode_reads_frames_off_the_calling_thread():
+    session = SessionController(camera=Camera(threaded=True, source=SyntheticSource()), model=FixedModel())
+    threads, accepted = set(), threading.Event()
+    try:
+        assert session.start_live(lambda letter, agreement, done: done and accepted.set(),
+                                  on_frame=lambda frame: threads.add(threading.get_ident()), every_nth=1)
+        assert accepted.wait(5)
+    finally:
+        session.shutdown()
+    assert threads and threading.get_ident() not in threads
+
+class ExclusiveModel:
+    # records whether two predictions ever ran at the same time
+    def __init__(self):
+        self.running = 0
+        self.overlapped = False
+
+    def make_prediction(self, frame):
+        self.running += 1
+        self.overlapped |= self.running > 1
+        time.sleep(0.002)
+        self.running -= 1
+        return 'b', None
+
+def test_live_and_captures_never_predict_at_once():
+    model = ExclusiveModel()
+    session = SessionController(camera=Camera(threaded=True, source=SyntheticSource()), model=model)
+    try:
+        assert session.start_live(lambda *result: None, every_nth=1)
+        for _ in range(20):
+            session.capture_and_predict_async().result()
+    finally:
+        session.shutdown()
+    assert not model.overlapped
+
+def test_live_mode_is_refused_until_the_model_is_loaded():
+    session = SessionController(camera=Camera(threaded=True, source=SyntheticSource()), model=FixedModel())
+    session._load_state = 'loading'
+    started = time.perf_counter()
+    try:
+        assert not session.start_live(lambda *result: None)
+    finally:
+        session.shutdown()
+    assert time.perf_counter() - started < 1
+
+def test_live_mode_needs_a_threaded_camera():
+    session = SessionController(camera=Camera(source=SyntheticSource()), model=FixedModel())
+    with pytest.raises(RuntimeError):
+        session.start_live(lambda *result: None)
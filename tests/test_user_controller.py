@@ -0,0 +1,27 @@
+'''File name: test_user_controller.py
+Contributers: Zoe Takacs and Wyatt Shaw
+Info: Tests of the user controller, run with python -m pytest
+'''
+import numpy as np
+
+from controller_classes import UserController
+
+def test_user_locks_do_not_grow_with_the_users_updated(tmp_path):
+    user_controller = UserController(str(tmp_path / "users"), backend='sqlite', cache_size=8)
+    for i in range(200):
+        user_controller.create_user(f"user{i}", "Beginner")
+        user_controller.update_user(f"user{i}", [1] * 26)
+    assert len(user_controller._user_locks) <= 8
+    assert user_controller.close()
+
+def test_update_score_leaves_published_profiles_unchanged(tmp_path):
+    user_controller = UserController(str(tmp_path / "users"), backend='sqlite')
+    user_controller.create_user("x", "Beginner")
+    published = user_controller.snapshot("x")
+    scores = published._p_let_scores.copy()
+
+    scored = user_controller.update_score(user_controller.find_user("x"), [1] * 26)
+    assert np.array_equal(published._p_let_scores, scores)
+    assert user_controller.snapshot("x") is scored and scored._p_let_scores[0] == 100
+    assert user_controller.close()
+    assert UserController(str(tmp_path / "users"), backend='sqlite').find_user("x")._p_let_scores[0] == 100
@@ -0,0 +1,243 @@
+'''File name: test_user_database.py
+Contributers: Zoe Takacs and Wyatt Shaw
+Info: Tests of the user databases, run with python -m pytest
+'''
+import os
+import threading
+import time
+
+import numpy as np
+import pytest
+
+from controller_classes import UserController
+from user_profile import User
+from user_database import JournaledPickleDatabase, PickleDatabase, RecordDatabase, SqliteDatabase, WriteBehindDatabase
+
+def set_level(level):
+    def apply(user):
+        user._proficiency = level
+    return apply
+
+def test_journal_changes_after_other_instance_compacts(tmp_path):
+    # two instances stand in for two processes sharing the database
+    first = JournaledPickleDatabase(str(tmp_path / "users"))
+    second = JournaledPickleDatabase(str(tmp_path / "users"))
+    first.put_user("x", User("x", "Beginner"))
+    second.load_db()
+    first.modify_user("x", set_level("Advanced"), User("x", "Beginner"))
+    first.compact()
+
+    assert second.take_changes()["x"]._proficiency == "Advanced"
+
+def test_journal_modify_reloads_after_compaction(tmp_path):
+    first = JournaledPickleDatabase(str(tmp_path / "users"))
+    second = JournaledPickleDatabase(str(tmp_path / "users"))
+    first.put_user("x", User("x", "Beginner"))
+    second.load_db()
+    first.modify_user("x", set_level("Advanced"), User("x", "Beginner"))
+    first.compact()
+
+    # without taking the changes first, the caller's copy is out of date
+    stored = second.modify_user("x", lambda user: None, User("x", "Beginner"))
+    assert stored._proficiency == "Advanced"
+
+def test_journal_export_keeps_changes_not_taken_yet(tmp_path):
+    first = JournaledPickleDatabase(str(tmp_path / "users"))
+    second = JournaledPickleDatabase(str(tmp_path / "users"))
+    first.put_user("x", User("x", "Beginner"))
+    second.load_db()
+    first.modify_user("x", set_level("Advanced"), User("x", "Beginner"))
+
+    assert dict(second.iter_users())["x"]._proficiency == "Advanced"
+    assert second.take_changes()["x"]._proficiency == "Advanced"
+
+def test_export_does_not_lose_lessons_of_other_processes(tmp_path):
+    first = UserController(str(tmp_path / "users"))
+    first.create_user("x", "Beginner")
+    second = UserController(str(tmp_path / "users"))
+    second.update_user("x", [0] * 26)
+    first.export_users(str(tmp_path / "users.jsonl"))
+    first.update_user("x", [1] * 26)
+
+    assert JournaledPickleDatabase(str(tmp_path / "users")).load_db()["x"].letter_history(0) == [0, 1]
+
+def test_own_writes_are_not_changes(tmp_path):
+    for db_class in (JournaledPickleDatabase, SqliteDatabase):
+        first = db_class(str(tmp_path / f"users_{db_class.__name__}"))
+        second = db_class(str(tmp_path / f"users_{db_class.__name__}"))
+        first.put_user("x", User("x", "Beginner"))
+        second.put_user("y", User("y", "Beginner"))
+        first.put_user("z", User("z", "Beginner"))
+
+        # each instance only sees what the other one wrote
+        assert set(first.take_changes()) == {"y"}
+        assert set(second.take_changes()) == {"x", "z"}
+        second.put_user("y", User("y", "Advanced"))
+        assert second.take_changes() == {}
+        assert first.take_changes()["y"]._proficiency == "Advanced"
+        first.close()
+        second.close()
+
+def test_journal_cuts_off_torn_record(tmp_path):
+    db = JournaledPickleDatabase(str(tmp_path / "users"))
+    db.put_user("x", User("x", "Beginner"))
+    size = os.path.getsize(db.journal_name)
+    db.put_user("y", User("y", "Beginner"))
+    # a crash in the middle of appending y
+    with open(db.journal_name, "r+b") as journal:
+        journal.truncate(os.path.getsize(db.journal_name) - 5)
+
+    reopened = JournaledPickleDatabase(str(tmp_path / "users"))
+    assert set(reopened.load_db()) == {"x"}
+    assert os.path.getsize(db.journal_name) == size
+    # records appended after the tear are kept
+    reopened.put_user("z", User("z", "Advanced"))
+    assert set(JournaledPickleDatabase(str(tmp_path / "users")).load_db()) == {"x", "z"}
+
+def test_journal_keeps_appends_made_during_compaction(tmp_path, monkeypatch):
+    db = JournaledPickleDatabase(str(tmp_path / "users"))
+    other = JournaledPickleDatabase(str(tmp_path / "users"))
+    for name in "abc":
+        db.put_user(name, User(name, "Beginner"))
+    compacted_size = os.path.getsize(db.journal_name)
+    load_snapshot = PickleDatabase.load_db
+
+    def load_while_appending(self):
+        # another process appends while the snapshot is being written, it does not wait for the compaction
+        data = load_snapshot(self)
+        other.put_user("d", User("d", "Advanced"))
+        return data
+
+    monkeypatch.setattr(PickleDatabase, "load_db", load_while_appending)
+    db.compact()
+    monkeypatch.undo()
+
+    assert set(JournaledPickleDatabase(str(tmp_path / "users")).load_db()) == {"a", "b", "c", "d"}
+    assert set(db.take_changes()) == {"d"}
+    # only the record appended meanwhile is left in the journal
+    assert os.path.getsize(db.journal_name) < compacted_size / 2
+
+class SlowDatabase(SqliteDatabase):
+    # writes wait for the test to release them, and fail while fail is set
+    def __init__(self, db_name):
+        super().__init__(db_name)
+        self.release = threading.Event()
+        self.fail = False
+
+    def put_user(self, name, user, data=None):
+        self.release.wait(5)
+        if self.fail:
+            raise OSError("disk full")
+        super().put_user(name, user, data)
+
+def test_write_behind_reads_in_flight_writes(tmp_path):
+    db = WriteBehindDatabase(SlowDatabase(str(tmp_path / "users")), delay=0)
+    db.put_user("x", User("x", "Beginner"))
+    # the background thread has taken the write and waits inside put_user
+    time.sleep(0.1)
+    assert db.has_user("x")
+    assert db.get_user("x")._proficiency == "Beginner"
+    db.save_db({"y": User("y", "Advanced")})
+    assert not db.has_user("x")
+    assert db.get_user("y")._proficiency == "Advanced"
+    db.db.release.set()
+    assert db.close(5)
+
+def test_write_behind_retries_failed_writes(tmp_path):
+    db = WriteBehindDatabase(SlowDatabase(str(tmp_path / "users")), delay=0)
+    db.db.fail = True
+    db.db.release.set()
+    db.put_user("x", User("x", "Beginner"))
+    assert not db.flush(5)
+    # a newer write queued meanwhile wins over the failed one
+    db.put_user("x", User("x", "Advanced"))
+    db.db.fail = False
+    assert db.flush(10)
+    assert db.db.get_user("x")._proficiency == "Advanced"
+    assert db.close(5)
+
+def test_write_behind_close_keeps_database_open_on_timeout(tmp_path):
+    db = WriteBehindDatabase(SlowDatabase(str(tmp_path / "users")), delay=0)
+    db.put_user("x", User("x", "Beginner"))
+    assert not db.close(0.1)
+    db.db.release.set()
+    # the write still goes through to the open database
+    db._thread.join(5)
+    assert db.db.get_user("x")._proficiency == "Beginner"
+    db.db.close()
+
+def scored_users(count, lessons=60):
+    rng = np.random.default_rng(2)
+    # scoring needs no database
+    scorer = UserController.__new__(UserController)
+    users = {}
+    for i in range(count):
+        user = User(f"user{i}", "Beginner")
+        for _ in range(rng.integers(0, lessons)):
+            scorer._score_lesson(user, rng.integers(0, 2, size=26).tolist())
+        user.update_proficiency()
+        users[user._name] = user
+    return users
+
+def assert_same_user(loaded, user):
+    for name in User.__slots__:
+        expected, actual = getattr(user, name), getattr(loaded, name)
+        if isinstance(expected, np.ndarray):
+            assert actual.dtype == expected.dtype and np.array_equal(actual, expected), name
+        else:
+            assert actual == expected, name
+
+def test_records_rebuild_exact_scores_from_histories(tmp_path):
+    users = scored_users(200)
+    db = RecordDatabase(str(tmp_path / "users"))
+    db.save_db(users)
+
+    loaded = RecordDatabase(str(tmp_path / "users")).load_db()
+    assert list(loaded) == list(users)
+    for name, user in users.items():
+        assert_same_user(loaded[name], user)
+    # only the histories and scalars are stored, about 280 bytes per user
+    assert os.path.getsize(db.db_name) < 300 * len(users)
+
+def test_records_write_single_users_in_place(tmp_path):
+    users = scored_users(3)
+    RecordDatabase(str(tmp_path / "users")).save_db(users)
+    size = os.path.getsize(tmp_path / "users.usr")
+    db = WriteBehindDatabase(RecordDatabase(str(tmp_path / "users")), delay=0)
+    db.modify_user("user1", set_level("Advanced"), users["user1"])
+    changed = users["user1"].copy()
+    changed._proficiency = "Advanced"
+    db.put_user("new", User("new", "Beginner"), None)
+    db.remove_user("user0", None)
+    assert db.close()
+
+    # the changed user kept its record, the new user was appended
+    assert os.path.getsize(tmp_path / "users.usr") > size
+    reopened = RecordDatabase(str(tmp_path / "users"))
+    assert not reopened.has_user("user0") and reopened.get_user("new")._proficiency == "Beginner"
+    assert_same_user(reopened.get_user("user1"), changed)
+    assert list(reopened.load_db()) == ["user1", "user2", "new"]
+
+def test_records_backend_migrates_pickle_database(tmp_path):
+    users = scored_users(4)
+    PickleDatabase(str(tmp_path / "users")).save_db(users)
+    user_controller = UserController(str(tmp_path / "users"), backend='records')
+    assert_same_user(user_controller.find_user("user3"), users["user3"])
+    assert user_controller.close()
+
+def test_sqlite_backend_retries_a_failed_migration(tmp_path, monkeypatch):
+    users = scored_users(4)
+    PickleDatabase(str(tmp_path / "users")).save_db(users)
+
+    def fail(self, data):
+        raise OSError("disk full")
+    with monkeypatch.context() as patch:
+        patch.setattr(SqliteDatabase, "save_db", fail)
+        with pytest.raises(OSError):
+            UserController(str(tmp_path / "users"), backend='sqlite')
+    # the failed import left no database behind, so the next start migrates again
+    assert not (tmp_path / "users.db").exists()
+    user_controller = UserController(str(tmp_path / "users"), backend='sqlite')
+    assert_same_user(user_controller.find_user("user3"), users["user3"])
+    assert user_controller.close()
+    assert not (tmp_path / "users.migrating.db-wal").exists()
@@ -0,0 +1,23 @@
+'''File name: test_user_profile.py
+Contributers: Zoe Takacs and Wyatt Shaw
+Info: Tests of the User profile, run with python -m pytest
+'''
+import pytest
+
+from user_profile import User
+
+def test_score_history_cannot_be_changed_in_place():
+    user = User("x", "Beginner")
+    user.push_result(0, 1)
+    with pytest.raises(AttributeError):
+        user._score_history[0].append(0)
+    with pytest.raises(TypeError):
+        user._score_history[0] = [0]
+    assert user._score_history[0] == (1,)
+
+def test_score_history_is_replaced_as_a_whole():
+    user = User("x", "Beginner")
+    user._score_history = [[1, 0, 1]] + [[] for _ in range(25)]
+    user.push_result(0, 0)
+    assert user._score_history[0] == (1, 0, 1, 0)
+    assert user.letter_history(0) == [1, 0, 1, 0]
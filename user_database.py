@@ -1,15 +1,54 @@
 '''File name: user_database.py
 Contributers: Zoe Takacs and Wyatt Shaw
-Info: Database and PickleDatabase class definition
+Info: Database, PickleDatabase, RecordDatabase, JournaledPickleDatabase, SqliteDatabase and WriteBehindDatabase class definition
 '''
+import io
 import json
+import os
 import pickle
+import sqlite3
+import struct
+import threading
+import time
+import zlib
+from contextlib import contextmanager
 from pathlib import Path
 import logging
 
+import numpy as np
+
+from user_profile import User, letter_scores, score_sums
+from metrics import span
+
 db_logger = logging.getLogger("Database")
 db_logger.setLevel(level = logging.INFO)
 
+def atomic_write(path, write, mode="wb") -> None:
+    '''Writes a file so that a crash leaves either the old or the new contents, never a mix
+
+    Args:
+        path (string): file to write
+        write (callable): called with the open temporary file
+        mode (string): "wb" or "w"
+    '''
+    path = Path(path)
+    tmp = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    with open(tmp, mode) as f:
+        write(f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+    sync_directory(path.parent)
+
+def sync_directory(directory) -> None:
+    # make a rename in the directory durable where directories can be synced
+    if hasattr(os, "O_DIRECTORY"):
+        fd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
 class Database:
     '''Functionalities of this class:
     - create, load, and save a database
@@ -33,7 +72,7 @@ class Database:
         db_logger.info(f"Loading DB = {self.db_name}")
         if Path(self.db_name).exists():
             #return the dictionary from the JSON
-            with open(self.db_name, "r") as db:
+            with span("db.json.load_db"), open(self.db_name, "r") as db:
                 return json.load(db)
         else:
             return self.db_create()
@@ -42,9 +81,62 @@ class Database:
         db_logger.info(f"Saving DB = {self.db_name}")
         if not self.db_data:
             db_logger.error("Saving Empty Database!")
-        with open(self.db_name, "w") as db:
-            #save the dictionary as a JSON
-            json.dump(data, db, indent=4)
+        #save the dictionary as a JSON
+        with span("db.json.save_db"):
+            atomic_write(self.db_name, lambda db: json.dump(data, db, indent=4), "w")
+
+    def has_user(self, name) -> bool:
+        # plain databases have to be loaded completely to look up a single user
+        return name in self.load_db()
+
+    def get_user(self, name):
+        return self.load_db().get(name)
+
+    def put_user(self, name, user, data) -> None:
+        # store one new or changed user; plain databases have to rewrite everything
+        self.save_db(data)
+
+    def iter_users(self):
+        # (name, user) pairs one at a time; plain databases can only be read as a whole
+        yield from self.load_db().items()
+
+    def put_users(self, users) -> None:
+        # store a batch of (name, user) pairs; plain databases have to rewrite everything
+        data = self.load_db()
+        data.update(users)
+        self.save_db(data)
+
+    def remove_user(self, name, data) -> None:
+        # remove one user; plain databases have to rewrite everything
+        self.save_db(data)
+
+    def modify_user(self, name, apply, current=None):
+        '''Applies a change to the latest stored version of a user and stores the result
+
+        Args:
+            name (string): username
+            apply (callable): changes the user passed to it in place
+            current (User): caller's copy, used by databases that cannot read a single user
+
+        Returns:
+            user (User): stored result, None if the user does not exist
+        '''
+        # plain databases have to load and rewrite everything
+        data = self.load_db()
+        user = data.get(name)
+        if user is None:
+            return None
+        apply(user)
+        self.save_db(data)
+        return user
+
+    def take_changes(self) -> dict:
+        # users other processes changed since the last call; a plain file is only used by one process
+        return {}
+
+    def close(self) -> None:
+        # file databases hold nothing open between calls
+        pass
 
 # New PickleDatabase class inheriting from Database
 class PickleDatabase(Database):
@@ -64,7 +156,7 @@ class PickleDatabase(Database):
         db_logger.info(f"Loading DB = {self.db_name}")
         if Path(self.db_name).exists():
             # Return the dictionary from the pickle file
-            with open(self.db_name, "rb") as db:  # Changed to 'rb' for binary reading
+            with span("db.pickle.load_db"), open(self.db_name, "rb") as db:  # Changed to 'rb' for binary reading
                 return pickle.load(db)
         else:
             return self.db_create()
@@ -73,9 +165,1072 @@ class PickleDatabase(Database):
         db_logger.info(f"Saving DB = {self.db_name}")
         if not data:
             db_logger.error("Saving Empty Database!")
-        with open(self.db_name, "wb") as db:  # Changed to 'wb' for binary writing
-            # Save the dictionary using pickle
-            pickle.dump(data, db) 
+        # Save the dictionary using pickle, to a temporary file first so a crash cannot corrupt the database
+        with span("db.pickle.save_db"):
+            atomic_write(self.db_name, lambda db: pickle.dump(data, db))
+
+
+class RecordDatabase(Database):
+    '''Functionalities of this class:
+    - load and save users in a versioned binary format that does not depend on the User class,
+      so loading runs no pickle code and changes to User cannot break old files
+    - stream users from and to the file one block of records at a time
+    - read, write and remove single users in place, a changed user overwrites its fixed-size record
+    - migrate pickle and JSON databases to the record format
+
+    File layout: a header (magic, schema version, letters per record, size of the fixed part of a record),
+    then blocks of users: a block header (user count, text size), the fixed-layout records holding the packed
+    histories and scalars, and the UTF-8 names the records refer to. Scores are not stored, they are rebuilt
+    from the histories on load. New users are appended as blocks of their own, removed users are only flagged
+    until the file is rewritten by save_db. Like the pickle file, a record file is used by one process only.
+
+    Attributes:
+    - same attributes as parent class
+    - _index (dict): name -> file offset of the record of every stored user, None until the first single-user access
+    - _end (int): file offset after the last complete block, where new users are appended
+    - _stamp_seen (tuple): stamp of the file the index was built from, the index is rebuilt when the file changes
+    - _lock (RLock): guards the index and the file, e.g. for a WriteBehindDatabase writing from its thread
+    '''
+    MAGIC = b"ASLUSERS"
+    # bump when the record layout changes and keep the old layout in _RECORDS, so old files stay readable
+    VERSION = 1
+    LETTERS = 26
+    # longest proficiency, in UTF-8 bytes, a fixed-size field keeps records the same size when a user changes
+    PROFICIENCY_BYTES = 32
+    _HEADER = struct.Struct("<8sHHI")
+    _BLOCK_HEADER = struct.Struct("<II")
+    # fixed part of a record per schema version, little-endian so files can be moved between machines
+    _RECORDS = {
+        1: np.dtype([("history_bits", "<u8", (LETTERS,)), ("history_len", "u1", (LETTERS,)),
+                     ("alpha", "<f8"), ("window", "<u2"), ("flags", "u1"),
+                     ("proficiency", f"S{PROFICIENCY_BYTES}"), ("name_len", "<u2")]),
+    }
+    # record flags
+    _DELETED = 1
+    # users per block, bounds the memory used while streaming (about 300 KB per block)
+    _BLOCK_USERS = 1024
+
+    def __init__(self, db_name: str = "data"):
+        self.db_name = f"{db_name}.usr" if not db_name.endswith(".usr") else db_name
+        self.db_data = {}
+        self._index = None
+        self._end = None
+        self._stamp_seen = None
+        self._lock = threading.RLock()
+
+    def load_db(self) -> dict:
+        db_logger.info(f"Loading DB = {self.db_name}")
+        if not Path(self.db_name).exists():
+            return self.db_create()
+        with span("db.records.load_db"):
+            return dict(self.iter_users())
+
+    def save_db(self, data) -> None:
+        db_logger.info(f"Saving DB = {self.db_name}")
+        if not data:
+            db_logger.error("Saving Empty Database!")
+        with span("db.records.save_db"):
+            self.dump_users(data.items())
+
+    def has_user(self, name) -> bool:
+        with self._lock:
+            return name in self._locate()
+
+    def get_user(self, name):
+        # one record is read, found through the index
+        with span("db.records.get_user"), self._lock:
+            offset = self._locate().get(name)
+            if offset is None:
+                return None
+            dtype = self._RECORDS[self.VERSION]
+            with open(self.db_name, "rb") as db:
+                db.seek(offset)
+                records = np.frombuffer(db.read(dtype.itemsize), dtype=dtype, count=1)
+            return next(self._users(records, name.encode("utf-8")))[1]
+
+    def put_user(self, name, user, data=None) -> None:
+        with span("db.records.put_user"):
+            self.put_users([(name, user)])
+
+    def put_users(self, users) -> None:
+        # stored users are overwritten in place, new ones are appended in blocks
+        users = list(users)
+        with self._lock:
+            index = self._locate()
+            if self._end is None:
+                self.dump_users(users)
+                return
+            with open(self.db_name, "r+b") as db:
+                added = []
+                for name, user in users:
+                    if name in index:
+                        db.seek(index[name])
+                        db.write(self._to_records([(name, user)])[0].tobytes())
+                    else:
+                        added.append((name, user))
+                if added:
+                    # a block torn by a crash while appending is cut off first
+                    db.seek(self._end)
+                    db.truncate()
+                    for start in range(0, len(added), self._BLOCK_USERS):
+                        self._write_block(db, added[start:start + self._BLOCK_USERS], index)
+                    self._end = db.tell()
+                db.flush()
+                os.fsync(db.fileno())
+            self._stamp_seen = self._stamp()
+
+    def remove_user(self, name, data=None) -> None:
+        # the record is flagged as removed, its space is reclaimed when the file is rewritten
+        with span("db.records.remove_user"), self._lock:
+            offset = self._locate().pop(name, None)
+            if offset is None:
+                return
+            dtype = self._RECORDS[self.VERSION]
+            with open(self.db_name, "r+b") as db:
+                db.seek(offset + dtype.fields["flags"][1])
+                db.write(bytes([self._DELETED]))
+                db.flush()
+                os.fsync(db.fileno())
+            self._stamp_seen = self._stamp()
+
+    def modify_user(self, name, apply, current=None):
+        with span("db.records.modify_user"), self._lock:
+            user = self.get_user(name)
+            if user is None:
+                return None
+            apply(user)
+            self.put_user(name, user)
+            return user
+
+    def iter_users(self):
+        '''Reads the users one block at a time
+
+        Yields:
+            (name, user) (tuple): username and User profile, in file order
+        '''
+        if not Path(self.db_name).exists():
+            return
+        with open(self.db_name, "rb") as db:
+            for _, records, text in self._blocks(db):
+                yield from self._users(records, text)
+
+    def _blocks(self, db):
+        # (file offset of the first record, records, text) of each block, a torn block at the end is skipped
+        dtype = self._read_header(db)
+        while True:
+            block_header = db.read(self._BLOCK_HEADER.size)
+            if len(block_header) < self._BLOCK_HEADER.size:
+                if block_header:
+                    db_logger.warning(f"Ignoring the incomplete block at the end of {self.db_name}")
+                return
+            count, text_size = self._BLOCK_HEADER.unpack(block_header)
+            offset = db.tell()
+            block = db.read(count * dtype.itemsize + text_size)
+            if len(block) < count * dtype.itemsize + text_size:
+                db_logger.warning(f"Ignoring the incomplete block at the end of {self.db_name}")
+                return
+            yield offset, np.frombuffer(block, dtype=dtype, count=count), block[count * dtype.itemsize:]
+
+    def _users(self, records, text):
+        # users of a block of records, the scores of the whole block are rebuilt at once
+        history_bits = records["history_bits"].astype(np.uint64)
+        history_len = records["history_len"].astype(np.uint8)
+        alphas = records["alpha"].tolist()
+        windows = records["window"].tolist()
+        # rows scored with the same parameters, window 0 marks users that were never scored with known parameters
+        groups = {}
+        for i, params in enumerate(zip(alphas, windows)):
+            groups.setdefault(params if params[1] else (), []).append(i)
+        scores = np.zeros(history_bits.shape)
+        weights = np.zeros(history_bits.shape)
+        for params, rows in groups.items():
+            scores[rows], weights[rows] = score_sums(history_bits[rows], history_len[rows], *params)
+        w_let_scores, p_let_scores, overall_scores = letter_scores(scores, weights, history_len)
+        flags = records["flags"].tolist()
+        proficiencies = records["proficiency"].tolist()
+        offset = 0
+        for i, name_len in enumerate(records["name_len"].tolist()):
+            name = text[offset:offset + name_len].decode("utf-8")
+            offset += name_len
+            if flags[i] & self._DELETED:
+                continue
+            user = User.__new__(User)
+            user._name = name
+            user._proficiency = proficiencies[i].decode("utf-8")
+            user._history_bits = history_bits[i]
+            user._history_len = history_len[i]
+            user._w_let_scores = w_let_scores[i]
+            user._p_let_scores = p_let_scores[i]
+            user._overall_score = float(overall_scores[i])
+            user._score_params = (alphas[i], windows[i]) if windows[i] else None
+            yield name, user
+
+    def _to_records(self, users):
+        # records of (name, user) pairs and the text holding their names
+        records = np.zeros(len(users), dtype=self._RECORDS[self.VERSION])
+        records["history_bits"] = np.stack([user._history_bits for _, user in users])
+        records["history_len"] = np.stack([user._history_len for _, user in users])
+        params = [user._score_params if user._score_params is not None else (np.nan, 0) for _, user in users]
+        records["alpha"] = [alpha for alpha, _ in params]
+        records["window"] = [window for _, window in params]
+        records["proficiency"] = self._proficiencies([user._proficiency.encode("utf-8") for _, user in users])
+        names = [name.encode("utf-8") for name, _ in users]
+        records["name_len"] = [len(name) for name in names]
+        return records, b"".join(names)
+
+    def _proficiencies(self, proficiencies):
+        # numpy would silently cut longer values
+        for proficiency in proficiencies:
+            if len(proficiency) > self.PROFICIENCY_BYTES:
+                raise ValueError(f"Proficiency {proficiency!r} is longer than {self.PROFICIENCY_BYTES} bytes")
+        return proficiencies
+
+    def _stamp(self):
+        try:
+            stat = os.stat(self.db_name)
+        except FileNotFoundError:
+            return None
+        return (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+    def _locate(self) -> dict:
+        # the index, rebuilt when the file was replaced or changed by someone else
+        stamp = self._stamp()
+        if self._index is not None and stamp == self._stamp_seen:
+            return self._index
+        index, end = {}, None
+        if stamp is not None:
+            with open(self.db_name, "rb") as db:
+                for offset, records, text in self._blocks(db):
+                    position = 0
+                    for i, (name_len, flags) in enumerate(zip(records["name_len"].tolist(), records["flags"].tolist())):
+                        if not flags & self._DELETED:
+                            index[text[position:position + name_len].decode("utf-8")] = offset + i * records.itemsize
+                        position += name_len
+                    end = db.tell()
+                if end is None:
+                    end = self._HEADER.size
+        self._index, self._end, self._stamp_seen = index, end, self._stamp()
+        return index
+
+    def dump_users(self, users) -> int:
+        '''Writes users one block at a time, replacing the file atomically
+
+        Args:
+            users (iterable): (name, user) pairs, e.g. a generator, so not all users have to be in memory
+
+        Returns:
+            count (int): number of users written
+        '''
+        dtype = self._RECORDS[self.VERSION]
+        count = 0
+
+        def write(db):
+            nonlocal count
+            db.write(self._HEADER.pack(self.MAGIC, self.VERSION, self.LETTERS, dtype.itemsize))
+            block = []
+            for item in users:
+                block.append(item)
+                if len(block) == self._BLOCK_USERS:
+                    self._write_block(db, block)
+                    count += len(block)
+                    block = []
+            if block:
+                self._write_block(db, block)
+                count += len(block)
+
+        with self._lock:
+            atomic_write(self.db_name, write)
+            # offsets changed, the index is rebuilt on the next single-user access
+            self._index = None
+        return count
+
+    def _write_block(self, db, block, index=None):
+        records, text = self._to_records(block)
+        db.write(self._BLOCK_HEADER.pack(len(block), len(text)))
+        if index is not None:
+            for i, (name, _) in enumerate(block):
+                index[name] = db.tell() + i * records.itemsize
+        db.write(records.tobytes())
+        db.write(text)
+
+    def _read_header(self, db):
+        header = db.read(self._HEADER.size)
+        if len(header) < self._HEADER.size:
+            raise ValueError(f"{self.db_name} is not a user record file")
+        magic, version, letters, record_size = self._HEADER.unpack(header)
+        if magic != self.MAGIC:
+            raise ValueError(f"{self.db_name} is not a user record file")
+        if version not in self._RECORDS:
+            raise ValueError(f"{self.db_name} has schema version {version}, this version reads up to {self.VERSION}")
+        dtype = self._RECORDS[version]
+        if letters != self.LETTERS or record_size != dtype.itemsize:
+            raise ValueError(f"{self.db_name} does not match schema version {version}")
+        return dtype
+
+    @classmethod
+    def migrate(cls, source, db_name=None):
+        '''Converts a pickle (PickleDatabase, JournaledPickleDatabase) or JSON (Database) database to the record format
+
+        JSON databases hold the attributes of each user as a dictionary, in the layout User.__setstate__ reads.
+        Accumulators missing from old profiles are rebuilt on the next update, as for old pickles.
+
+        Args:
+            source (Database): database to read
+            db_name (string): record file to write, next to the source by default
+
+        Returns:
+            db (RecordDatabase): the new database
+        '''
+        if db_name is None:
+            db_name = str(Path(source.db_name).with_suffix(""))
+        db = cls(db_name)
+        data = source.load_db()
+        count = db.dump_users((name, cls._as_user(name, value)) for name, value in data.items())
+        db_logger.info(f"Migrated {count} users from {source.db_name} to {db.db_name}")
+        return db
+
+    @staticmethod
+    def _as_user(name, value):
+        if isinstance(value, User):
+            return value
+        user = User.__new__(User)
+        user.__setstate__({"_name": name, **value})
+        return user
+
+
+class FileLock:
+    '''Functionalities of this class:
+    - exclusive lock on a file, shared between processes and between the threads of this process
+    - reentrant, so locked methods can call each other
+
+    Attributes:
+    - path (string): lock file, created if missing
+    - _thread_lock (RLock): orders the threads of this process before they take the file lock
+    - _depth (int): how often the current holder has entered the lock
+    - _file: open lock file while the lock is held
+    '''
+    def __init__(self, path):
+        self.path = path
+        self._thread_lock = threading.RLock()
+        self._depth = 0
+        self._file = None
+
+    def __enter__(self):
+        self._thread_lock.acquire()
+        if self._depth == 0:
+            self._file = open(self.path, "a+b")
+            if os.name == "nt":
+                import msvcrt
+                self._file.seek(0)
+                # LK_LOCK gives up after about 10 seconds, keep trying until the other process is done
+                while True:
+                    try:
+                        msvcrt.locking(self._file.fileno(), msvcrt.LK_LOCK, 1)
+                        break
+                    except OSError:
+                        continue
+            else:
+                import fcntl
+                fcntl.flock(self._file.fileno(), fcntl.LOCK_EX)
+        self._depth += 1
+        return self
+
+    def __exit__(self, *exc):
+        self._depth -= 1
+        if self._depth == 0:
+            if os.name == "nt":
+                import msvcrt
+                self._file.seek(0)
+                msvcrt.locking(self._file.fileno(), msvcrt.LK_UNLCK, 1)
+            else:
+                import fcntl
+                fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+            self._file.close()
+            self._file = None
+        self._thread_lock.release()
+
+
+class JournaledPickleDatabase(PickleDatabase):
+    '''Functionalities of this class:
+    - append per-user changes to a journal file instead of re-pickling every user on each save
+    - replay the journal over the last snapshot on load; each record is framed with its length and a checksum,
+      so a record torn by a crash is recognized and cut off before anything is appended after it
+    - compact the journal into a new snapshot in the background once it grows past a threshold
+    - can be shared by several processes: writes are serialized with a lock file, and each process
+      picks up what the others changed by reading the journal from where it last stopped
+
+    Attributes:
+    - journal_name (string): file the change records are appended to, next to the snapshot
+    - compact_threshold (int): journal size in bytes that triggers a background compaction
+    - _lock (FileLock): serializes snapshot, journal and compaction writes across processes and threads
+    - _compaction (Thread): running background compaction, None when idle
+    - _offset (int): journal offset this process has read up to
+    - _snapshot_stamp (tuple): identity of the snapshot file at the last read, a new one means a full reload
+    - _changes (dict): name -> user (None if deleted) changed by others and not yet taken by take_changes
+    '''
+    JOURNAL_MAGIC = b"ASLJRNL1"
+    # frame of each journal record: length and CRC32 of the pickled record
+    _RECORD = struct.Struct("<II")
+
+    def __init__(self, db_name: str = "data", compact_threshold: int = 4 * 1024 * 1024):
+        super().__init__(db_name)
+        self.journal_name = f"{self.db_name}.journal"
+        self.compact_threshold = compact_threshold
+        self._lock = FileLock(f"{self.db_name}.lock")
+        self._compaction = None
+        self._offset = 0
+        self._snapshot_stamp = None
+        self._changes = {}
+
+    @staticmethod
+    def _apply(data, record, keep_deleted) -> None:
+        action, name, user = record
+        if action == "put":
+            data[name] = user
+        elif keep_deleted:
+            data[name] = None
+        else:
+            data.pop(name, None)
+
+    def _replay(self, data, journal, keep_deleted=False) -> int:
+        # apply the complete records from the current position on, returns the offset after the last one
+        offset = journal.tell()
+        while True:
+            header = journal.read(self._RECORD.size)
+            if len(header) < self._RECORD.size:
+                break
+            length, checksum = self._RECORD.unpack(header)
+            payload = journal.read(length)
+            if len(payload) < length or zlib.crc32(payload) != checksum:
+                # torn by a crash while appending
+                break
+            # a complete record that cannot be loaded is a real error, not the end of the journal
+            self._apply(data, pickle.loads(payload), keep_deleted)
+            offset = journal.tell()
+        return offset
+
+    def _read_journal(self, data, offset=0, keep_deleted=False) -> int:
+        '''Replays the journal from offset into data, under the lock, and cuts off a torn record at its end
+
+        Returns:
+            offset (int): end of the last complete record, where the next record is appended
+        '''
+        if not Path(self.journal_name).exists():
+            return 0
+        with open(self.journal_name, "r+b") as journal:
+            if offset < len(self.JOURNAL_MAGIC):
+                magic = journal.read(len(self.JOURNAL_MAGIC))
+                if not magic:
+                    return 0
+                if magic != self.JOURNAL_MAGIC:
+                    raise ValueError(f"{self.journal_name} is not a user journal")
+                offset = len(self.JOURNAL_MAGIC)
+            journal.seek(offset)
+            offset = self._replay(data, journal, keep_deleted)
+            if journal.seek(0, os.SEEK_END) > offset:
+                # writers hold the lock, so what follows the last complete record is left over from a crash
+                db_logger.warning(f"Cutting a torn record off the end of {self.journal_name}")
+                journal.truncate(offset)
+                journal.flush()
+                os.fsync(journal.fileno())
+        return offset
+
+    def _stamp(self):
+        try:
+            stat = os.stat(self.db_name)
+        except FileNotFoundError:
+            return None
+        return (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+    def load_db(self) -> dict:
+        with span("db.journal.load_db"), self._lock:
+            data = super().load_db()
+            self._snapshot_stamp = self._stamp()
+            self._offset = self._read_journal(data)
+            self._changes = {}
+        return data
+
+    def iter_users(self):
+        # a separate read of snapshot and journal, the changes not taken yet and the journal offset stay as they are
+        with span("db.journal.iter_users"), self._lock:
+            data = PickleDatabase.load_db(self)
+            self._read_journal(data)
+        yield from data.items()
+
+    def save_db(self, data) -> None:
+        # a full save is a snapshot, after which the journal is empty
+        with span("db.journal.save_db"), self._lock:
+            super().save_db(data)
+            atomic_write(self.journal_name, lambda journal: None)
+            self._snapshot_stamp = self._stamp()
+            self._offset = 0
+
+    def _poll(self) -> None:
+        # collect what other processes changed since this process last read the journal
+        with self._lock:
+            if self._stamp() != self._snapshot_stamp:
+                # another process compacted or saved a full snapshot, everything may have changed;
+                # load_db starts a new _changes, so keep the changes collected so far and the reload separately
+                changes = self._changes
+                data = self.load_db()
+                self._changes = {**changes, **data}
+                return
+            if not Path(self.journal_name).exists() or os.path.getsize(self.journal_name) <= self._offset:
+                return
+            self._offset = self._read_journal(self._changes, self._offset, keep_deleted=True)
+
+    def take_changes(self) -> dict:
+        '''Users changed in the database since the last call, by any process
+
+        Returns:
+            changes (dict): name -> latest user, None for deleted users
+        '''
+        self._poll()
+        with self._lock:
+            changes, self._changes = self._changes, {}
+        return changes
+
+    def _append(self, *records) -> None:
+        with span("db.journal.append"), self._lock:
+            # read up to the end of the journal first, so reading past our own records skips only them
+            self._poll()
+            with open(self.journal_name, "ab") as journal:
+                if journal.tell() == 0:
+                    journal.write(self.JOURNAL_MAGIC)
+                for record in records:
+                    payload = pickle.dumps(record)
+                    journal.write(self._RECORD.pack(len(payload), zlib.crc32(payload)) + payload)
+                journal.flush()
+                os.fsync(journal.fileno())
+                size = journal.tell()
+            # this process's own writes are no changes by others, but must not leave an older change behind
+            self._offset = size
+            for record in records:
+                if record[1] in self._changes:
+                    self._apply(self._changes, record, keep_deleted=True)
+        if size > self.compact_threshold:
+            self.compact_in_background()
+
+    def put_user(self, name, user, data=None) -> None:
+        self._append(("put", name, user))
+
+    def put_users(self, users) -> None:
+        # a whole batch is appended under one lock with a single fsync
+        self._append(*(("put", name, user) for name, user in users))
+
+    def remove_user(self, name, data=None) -> None:
+        self._append(("delete", name, None))
+
+    def modify_user(self, name, apply, current=None):
+        # read-modify-write of one user under the lock, starting from the latest version any process wrote
+        with span("db.journal.modify_user"), self._lock:
+            self._poll()
+            if name in self._changes:
+                current = self._changes[name]
+            if current is None:
+                return None
+            user = current.copy()
+            apply(user)
+            self.put_user(name, user)
+            return user
+
+    def compact_in_background(self) -> None:
+        if self._compaction is not None and self._compaction.is_alive():
+            return
+        self._compaction = threading.Thread(target=self.compact, name="journal-compaction", daemon=True)
+        self._compaction.start()
+
+    def compact(self) -> None:
+        # fold the journal into a new snapshot entirely on disk, so in-memory users are never touched;
+        # the snapshot is written without holding the lock, so appends of every process go on meanwhile
+        with self._lock:
+            # pick up everything first, the new snapshot makes every process do a full reload otherwise
+            self._poll()
+            stamp, offset = self._snapshot_stamp, self._offset
+        if offset == 0:
+            return
+        db_logger.info(f"Compacting DB = {self.db_name}")
+        data = PickleDatabase.load_db(self)
+        with open(self.journal_name, "rb") as journal:
+            # records up to offset are complete and never change, appends only go after them
+            journal.seek(len(self.JOURNAL_MAGIC))
+            self._replay(data, io.BytesIO(journal.read(offset - len(self.JOURNAL_MAGIC))))
+        tmp = Path(f"{self.db_name}.{os.getpid()}.compact.tmp")
+        with open(tmp, "wb") as db:
+            pickle.dump(data, db)
+            db.flush()
+            os.fsync(db.fileno())
+        del data
+
+        with self._lock:
+            if self._stamp() != stamp:
+                # another process saved or compacted meanwhile, its snapshot wins
+                tmp.unlink()
+                return
+            # the tail appended meanwhile is carried over to the new journal, after reading it like any change
+            self._poll()
+            with open(self.journal_name, "rb") as journal:
+                journal.seek(offset)
+                tail = journal.read(self._offset - offset)
+            os.replace(tmp, self.db_name)
+            sync_directory(Path(self.db_name).parent)
+            atomic_write(self.journal_name, lambda journal: journal.write(self.JOURNAL_MAGIC + tail) if tail else None)
+            self._snapshot_stamp = self._stamp()
+            self._offset = len(self.JOURNAL_MAGIC) + len(tail) if tail else 0
+
+
+class SqliteDatabase(Database):
+    '''Functionalities of this class:
+    - store every user as one row of a local SQLite file (WAL mode, indexed by username)
+    - look up, update and delete single users without loading the others
+    - can be shared by several processes: read-modify-write happens in one immediate transaction, and
+      every write is logged in a changes table so each process only reloads what the others changed
+
+    Attributes:
+    - db_name (string): SQLite file, .db is added if missing
+    - _conn (Connection): connection shared by all threads, guarded by _lock; transactions are explicit
+    - _lock (RLock): serializes access to the connection
+    - _last_change (int): latest change already seen by this process
+    - _own_changes (set): changes this process committed after _last_change, skipped by take_changes
+    - _logged (list): changes logged by the open transaction, own changes once it commits
+    - _data_version (int): PRAGMA data_version at the last poll, unchanged means no other connection wrote
+    '''
+    _COLUMNS = "username, proficiency, overall_score, score_alpha, score_window, scores"
+    _UPSERT = f"""INSERT INTO users ({_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?)
+        ON CONFLICT (username) DO UPDATE SET proficiency = excluded.proficiency, overall_score = excluded.overall_score,
+        score_alpha = excluded.score_alpha, score_window = excluded.score_window, scores = excluded.scores"""
+    # name logged by a full save, everything has to be reloaded
+    _ALL_USERS = "*"
+    # change log entries kept for processes that have not polled for a while
+    _CHANGES_KEPT = 100000
+
+    def __init__(self, db_name: str = "data", timeout: float = 30.0):
+        self.db_name = f"{db_name}.db" if not db_name.endswith(".db") else db_name
+        self.db_data = {}
+        self._lock = threading.RLock()
+        self._own_changes = set()
+        self._logged = []
+        self._conn = sqlite3.connect(self.db_name, timeout=timeout, check_same_thread=False, isolation_level=None)
+        # pragmas cannot be changed inside a transaction
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        with self._transaction():
+            # scores holds the fixed-layout arrays of User.pack_scores
+            self._conn.execute("""CREATE TABLE IF NOT EXISTS users (
+                username TEXT NOT NULL,
+                proficiency TEXT NOT NULL,
+                overall_score REAL NOT NULL,
+                score_alpha REAL,
+                score_window INTEGER,
+                scores BLOB NOT NULL)""")
+            self._conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS users_username ON users (username)")
+            self._conn.execute("""CREATE TABLE IF NOT EXISTS changes (
+                change_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                username TEXT NOT NULL)""")
+            self._last_change = self._conn.execute("SELECT COALESCE(MAX(change_id), 0) FROM changes").fetchone()[0]
+        self._data_version = self._conn.execute("PRAGMA data_version").fetchone()[0]
+
+    @contextmanager
+    def _transaction(self):
+        # BEGIN IMMEDIATE takes the write lock up front, so a read-modify-write cannot interleave with another process
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._conn
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                # ids of rolled back changes may be handed out again, to another process
+                self._logged = []
+                raise
+            self._conn.execute("COMMIT")
+            self._own_committed(self._logged)
+            self._logged = []
+
+    def _own_committed(self, change_ids) -> None:
+        # this process's own writes are no changes by others: move past them when caught up, remember them otherwise
+        for change_id in sorted(change_ids):
+            if change_id == self._last_change + 1:
+                self._last_change = change_id
+            else:
+                self._own_changes.add(change_id)
+        while self._last_change + 1 in self._own_changes:
+            self._last_change += 1
+            self._own_changes.discard(self._last_change)
+
+    def _log_change(self, name) -> None:
+        change_id = self._conn.execute("INSERT INTO changes (username) VALUES (?)", (name,)).lastrowid
+        self._logged.append(change_id)
+        if change_id % 1000 == 0:
+            self._conn.execute("DELETE FROM changes WHERE change_id <= ?", (change_id - self._CHANGES_KEPT,))
+
+    @staticmethod
+    def _to_row(name, user):
+        alpha, window = user._score_params if user._score_params is not None else (None, None)
+        return (name, user._proficiency, float(user._overall_score), alpha, window, user.pack_scores())
+
+    @staticmethod
+    def _from_row(row):
+        name, proficiency, overall_score, alpha, window, scores = row
+        user = User(name, proficiency)
+        user.unpack_scores(scores)
+        user._overall_score = overall_score
+        user._score_params = (alpha, window) if alpha is not None else None
+        return user
+
+    def load_db(self) -> dict:
+        db_logger.info(f"Loading DB = {self.db_name}")
+        with span("db.sqlite.load_db"):
+            with self._lock:
+                rows = self._conn.execute(f"SELECT {self._COLUMNS} FROM users").fetchall()
+            return {row[0]: self._from_row(row) for row in rows}
+
+    def save_db(self, data) -> None:
+        # a full save replaces every row in one transaction
+        db_logger.info(f"Saving DB = {self.db_name}")
+        if not data:
+            db_logger.error("Saving Empty Database!")
+        with span("db.sqlite.save_db"), self._transaction():
+            self._conn.execute("DELETE FROM users")
+            self._conn.executemany(self._UPSERT, (self._to_row(name, user) for name, user in data.items()))
+            self._log_change(self._ALL_USERS)
+
+    def has_user(self, name) -> bool:
+        with self._lock:
+            return self._conn.execute("SELECT 1 FROM users WHERE username = ?", (name,)).fetchone() is not None
+
+    def get_user(self, name):
+        with span("db.sqlite.get_user"), self._lock:
+            row = self._conn.execute(f"SELECT {self._COLUMNS} FROM users WHERE username = ?", (name,)).fetchone()
+        return self._from_row(row) if row is not None else None
+
+    def put_user(self, name, user, data=None) -> None:
+        with span("db.sqlite.put_user"), self._transaction():
+            self._conn.execute(self._UPSERT, self._to_row(name, user))
+            self._log_change(name)
+
+    def put_users(self, users) -> None:
+        # a whole batch in one transaction
+        users = list(users)
+        with self._transaction():
+            self._conn.executemany(self._UPSERT, (self._to_row(name, user) for name, user in users))
+            for name, _ in users:
+                self._log_change(name)
+
+    def iter_users(self, batch_size: int = 1000):
+        '''Reads the users in username order, batch_size rows at a time
+
+        Each batch is a separate query continuing after the last username, so no cursor or lock is held
+        while the caller works through a batch.
+
+        Yields:
+            (name, user) (tuple): username and User profile
+        '''
+        last = None
+        while True:
+            with self._lock:
+                if last is None:
+                    rows = self._conn.execute(f"SELECT {self._COLUMNS} FROM users ORDER BY username LIMIT ?",
+                                              (batch_size,)).fetchall()
+                else:
+                    rows = self._conn.execute(f"SELECT {self._COLUMNS} FROM users WHERE username > ? "
+                                              "ORDER BY username LIMIT ?", (last, batch_size)).fetchall()
+            for row in rows:
+                yield row[0], self._from_row(row)
+            if len(rows) < batch_size:
+                return
+            last = rows[-1][0]
+
+    def remove_user(self, name, data=None) -> None:
+        with self._transaction():
+            self._conn.execute("DELETE FROM users WHERE username = ?", (name,))
+            self._log_change(name)
+
+    def modify_user(self, name, apply, current=None):
+        # read-modify-write of one user in a single transaction, starting from the stored row
+        with span("db.sqlite.modify_user"), self._transaction():
+            user = self.get_user(name)
+            if user is None:
+                return None
+            apply(user)
+            self._conn.execute(self._UPSERT, self._to_row(name, user))
+            self._log_change(name)
+            return user
+
+    def take_changes(self) -> dict:
+        '''Users changed in the database since the last call, by any process
+
+        Returns:
+            changes (dict): name -> latest user, None for deleted users
+        '''
+        with self._lock:
+            data_version = self._conn.execute("PRAGMA data_version").fetchone()[0]
+            if data_version == self._data_version:
+                # no other connection has committed anything
+                return {}
+            self._data_version = data_version
+            rows = self._conn.execute("SELECT change_id, username FROM changes WHERE change_id > ? ORDER BY change_id",
+                                      (self._last_change,)).fetchall()
+            if not rows:
+                return {}
+            self._last_change = rows[-1][0]
+            names = {name for change_id, name in rows if change_id not in self._own_changes}
+            self._own_changes = {change_id for change_id in self._own_changes if change_id > self._last_change}
+            if not names:
+                return {}
+        if self._ALL_USERS in names:
+            return self.load_db()
+        return {name: self.get_user(name) for name in names}
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+class WriteBehindDatabase:
+    '''Functionalities of this class:
+    - queue saves of another database and write them from a background thread, so callers return immediately
+    - coalesce rapid successive saves, only the latest state of each user is written
+    - reads see queued and in-flight writes until the database has them
+    - retry failed writes, keeping them under newer ones queued meanwhile
+    - flush the queue on demand, e.g. before shutdown
+
+    The wrapped database should support per-user writes (JournaledPickleDatabase, SqliteDatabase).
+
+    Attributes:
+    - db (Database): database the writes go to
+    - delay (float): seconds to wait after a save before writing, so that saves arriving meanwhile are coalesced
+    - _pending (dict): name -> snapshot of the user to write, None to delete the user, or a
+      ("modify", base, applies) tuple for changes to apply to the latest stored version
+    - _full (dict): snapshot of a full save still to be written, written before _pending
+    - _inflight (dict), _inflight_full (dict): batch the background thread is writing, visible until it is written
+    - _failures (int): writes that failed so far, each is retried
+    - _condition (Condition): guards the queue and the in-flight batch
+    '''
+    # attempts at writing what is left once closing, before giving up on it
+    _CLOSE_ATTEMPTS = 3
+    # longest wait between retries of a failing write, in seconds
+    _MAX_RETRY_DELAY = 5.0
+    _MISSING = object()
+
+    def __init__(self, db, delay: float = 0.2):
+        self.db = db
+        self.delay = delay
+        self._pending = {}
+        self._full = None
+        self._inflight = {}
+        self._inflight_full = None
+        self._busy = False
+        self._closed = False
+        self._failures = 0
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name="write-behind", daemon=True)
+        self._thread.start()
+
+    def load_db(self) -> dict:
+        self.flush()
+        return self.db.load_db()
+
+    def save_db(self, data) -> None:
+        # snapshot now, the users may keep changing while the write is pending
+        snapshot = {name: user.copy() for name, user in data.items()}
+        with self._condition:
+            self._full = snapshot
+            self._pending.clear()
+            self._condition.notify_all()
+
+    def _queued(self, name):
+        '''Latest queued or in-flight state of a user, under the condition
+
+        Returns:
+            (found, user, applies) (tuple): found is False when only the database knows the user;
+                applies are queued changes, oldest first, to apply on top of user
+        '''
+        applies = []
+        # newest first: queued writes, a queued full save, the in-flight writes, an in-flight full save
+        for layer, complete in ((self._pending, False), (self._full, True),
+                                (self._inflight, False), (self._inflight_full, True)):
+            if layer is None:
+                continue
+            entry = layer.get(name, self._MISSING)
+            if entry is self._MISSING:
+                if complete:
+                    # a full save replaces every user, one missing from it is deleted
+                    return True, None, applies
+                continue
+            if isinstance(entry, tuple):
+                applies = entry[2] + applies
+                continue
+            return True, entry, applies
+        return False, None, applies
+
+    def has_user(self, name) -> bool:
+        with self._condition:
+            found, user, _ = self._queued(name)
+        if found:
+            return user is not None
+        return self.db.has_user(name)
+
+    def get_user(self, name):
+        with self._condition:
+            found, user, applies = self._queued(name)
+            user = user.copy() if user is not None else None
+        if not found:
+            user = self.db.get_user(name)
+        for apply in applies if user is not None else []:
+            apply(user)
+        return user
+
+    def modify_user(self, name, apply, current=None):
+        # queued like a put, the read-modify-write runs on the background thread; returns current optimistically
+        with self._condition:
+            pending = self._pending.get(name, False)
+            if pending is None:
+                return None
+            if isinstance(pending, User):
+                apply(pending)
+            elif pending:
+                pending[2].append(apply)
+            else:
+                self._pending[name] = ("modify", current.copy() if current is not None else None, [apply])
+            self._condition.notify_all()
+        return current
+
+    def take_changes(self) -> dict:
+        # users with writes queued or in flight keep their local state until the write is done
+        changes = self.db.take_changes()
+        with self._condition:
+            if self._full is not None or self._inflight_full is not None:
+                # a full save overwrites every change
+                return {}
+            return {name: user for name, user in changes.items() if name not in self._pending and name not in self._inflight}
+
+    def iter_users(self):
+        self.flush()
+        return self.db.iter_users()
+
+    def put_users(self, users) -> None:
+        # bulk writes are not waited on by the GUI, they go straight to the database after the queued writes
+        self.flush()
+        self.db.put_users(users)
+
+    def put_user(self, name, user, data=None) -> None:
+        snapshot = user.copy()
+        with self._condition:
+            self._pending[name] = snapshot
+            self._condition.notify_all()
+
+    def remove_user(self, name, data=None) -> None:
+        with self._condition:
+            self._pending[name] = None
+            self._condition.notify_all()
+
+    def _write(self, full, pending) -> None:
+        # writes a batch, removing every item from it once written, so only the rest is retried after an error
+        with span("db.write_behind.write"):
+            if full is not None:
+                self.db.save_db(full)
+                with self._condition:
+                    self._inflight_full = None
+            for name in list(pending):
+                user = pending[name]
+                if user is None:
+                    self.db.remove_user(name, None)
+                elif isinstance(user, User):
+                    self.db.put_user(name, user, None)
+                else:
+                    _, base, applies = user
+                    self.db.modify_user(name, lambda stored: [apply(stored) for apply in applies], base)
+                with self._condition:
+                    del pending[name]
+
+    def _requeue(self, full, pending) -> None:
+        # puts the unwritten rest of a failed batch back under the writes queued meanwhile, under the condition
+        if self._full is not None:
+            # a newer full save replaces all of it
+            return
+        if full is not None:
+            self._full = full
+        for name, older in pending.items():
+            newer = self._pending.get(name, self._MISSING)
+            if newer is self._MISSING:
+                self._pending[name] = older
+            elif isinstance(newer, tuple) and older is None:
+                # changes to a deleted user do nothing
+                self._pending[name] = None
+            elif isinstance(newer, tuple):
+                # queued changes still have to be applied on top of the older write
+                if isinstance(older, User):
+                    for apply in newer[2]:
+                        apply(older)
+                    self._pending[name] = older
+                else:
+                    self._pending[name] = ("modify", older[1], older[2] + newer[2])
+
+    def _run(self) -> None:
+        failures = 0
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._pending or self._full is not None or self._closed)
+                if self._closed and not self._pending and self._full is None:
+                    return
+            if not self._closed:
+                time.sleep(self.delay)
+            with self._condition:
+                self._inflight_full, self._inflight = self._full, self._pending
+                self._full, self._pending = None, {}
+                self._busy = True
+            try:
+                self._write(self._inflight_full, self._inflight)
+                failures = 0
+            except Exception as e:
+                failures += 1
+                db_logger.error(f"Error! Could not save to {getattr(self.db, 'db_name', self.db)}, "
+                                f"attempt {failures} is retried. Error {e}")
+                with self._condition:
+                    self._requeue(self._inflight_full, self._inflight)
+                    self._failures += 1
+                    self._condition.notify_all()
+                    if self._closed and failures >= self._CLOSE_ATTEMPTS:
+                        lost = sorted(self._pending) + (["all users"] if self._full is not None else [])
+                        db_logger.error(f"Error! Giving up, the changes of {', '.join(map(str, lost))} were not saved")
+                        self._pending, self._full = {}, None
+                if not self._closed:
+                    time.sleep(min(max(self.delay, 0.05) * 2 ** failures, self._MAX_RETRY_DELAY))
+            finally:
+                with self._condition:
+                    self._inflight_full, self._inflight = None, {}
+                    self._busy = False
+                    self._condition.notify_all()
+
+    def flush(self, timeout=None) -> bool:
+        # wait until everything queued so far has been written, returns False on timeout or when a write failed
+        with self._condition:
+            failures = self._failures
+            self._condition.notify_all()
+            return self._condition.wait_for(
+                lambda: self._failures != failures or (not self._pending and self._full is None and not self._busy),
+                timeout) and self._failures == failures
+
+    def close(self, timeout=None) -> bool:
+        '''Writes what is queued and closes the wrapped database
+
+        Returns:
+            saved (bool): False when the writes did not finish within timeout; the wrapped database stays open then,
+                the background thread keeps writing until the process exits
+        '''
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            with self._condition:
+                unsaved = sorted({*self._pending, *self._inflight}) + (
+                    ["all users"] if self._full is not None or self._inflight_full is not None else [])
+            db_logger.error(f"Error! Closing {getattr(self.db, 'db_name', self.db)} timed out, "
+                            f"the changes of {', '.join(map(str, unsaved))} may not be saved")
+            return False
+        self.db.close()
+        return True
 
 
 if __name__ == "__main__":
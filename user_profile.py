@@ -0,0 +1,199 @@
+'''File name: user_profile.py
+Contributers: Zoe Takacs and Wyatt Shaw
+Info: User class definition and score computation, shared by the user databases and the controllers without
+      pulling in the model or camera
+'''
+from functools import lru_cache
+
+import numpy as np
+
+# proficiency levels in points
+MIN_LEVEL = 35.0
+MED_LEVEL = 60.0
+MAX_LEVEL = 85.0
+
+class User:
+    '''Functionalities for the User class: 
+        - create/edit/view a profile
+        - keep track of their scores on various trials
+        - display their progress over time
+
+    FUTURE DEVELOPMENT NOTE: could have different levels of user which have access to different prompt sets or types of services;
+    this could allow us to implement inheritance
+
+    Attributes: 
+        _name (string): username
+        _proficiency (string): quantized level user is on
+        _history_bits (uint64 array): last (up to) 50 scores per letter packed as bits, bit j is the attempt j lessons ago (1=correct)
+        _history_len (uint8 array): number of attempts stored per letter
+        _w_let_scores (float32 array): weighted letter scores
+        _p_let_scores (float32 array): letter scores on a scale of 0-100 (%)
+        _overall_score (float): equally weighted average of letter scores
+        _score_params (tuple): (alpha, max_storage) the letter scores were computed with, None if they need a recompute
+    '''
+    # slots and fixed-size arrays keep large user databases small, both in memory and pickled
+    __slots__ = ('_name', '_proficiency', '_history_bits', '_history_len', '_w_let_scores', '_p_let_scores',
+                 '_overall_score', '_score_params')
+
+    # one uint64 per letter holds the history
+    MAX_HISTORY = 64
+
+    def __init__(self, name, proficiency):
+        self._name = name
+        self._proficiency = proficiency
+        self._history_bits = np.zeros(26, dtype=np.uint64)
+        self._history_len = np.zeros(26, dtype=np.uint8)
+        self._w_let_scores = np.zeros(26, dtype=np.float32)
+        self._p_let_scores = np.zeros(26, dtype=np.float32)
+        self._overall_score = 0.0
+        self._score_params = None
+
+    def push_result(self, letter, result, max_storage=50):
+        # adds the latest result to a letter's history, keeping only the latest max_storage results
+        if max_storage > self.MAX_HISTORY:
+            raise ValueError(f"Cannot store more than {self.MAX_HISTORY} attempts per letter")
+        bits = (int(self._history_bits[letter]) << 1) | (1 if result else 0)
+        length = int(self._history_len[letter]) + 1
+        self._history_bits[letter] = bits & ((1 << max_storage) - 1)
+        self._history_len[letter] = min(length, max_storage)
+
+    def letter_history(self, letter):
+        # results of a letter as a list, oldest first
+        bits = int(self._history_bits[letter])
+        return [(bits >> age) & 1 for age in reversed(range(int(self._history_len[letter])))]
+
+    @property
+    def _score_history(self):
+        # copy of the packed history per letter, oldest first, as stored before the compact layout;
+        # tuples, so code still appending to it fails instead of changing a copy, new results go through push_result
+        return tuple(tuple(self.letter_history(letter)) for letter in range(len(self._history_len)))
+
+    @_score_history.setter
+    def _score_history(self, score_history):
+        for letter, history in enumerate(score_history):
+            history = history[-self.MAX_HISTORY:]
+            self._history_bits[letter] = sum((1 if result else 0) << age for age, result in enumerate(reversed(history)))
+            self._history_len[letter] = len(history)
+
+    # array attributes and their dtypes, pickled as raw bytes to avoid per-array pickle overhead
+    _ARRAYS = (('_history_bits', np.uint64), ('_history_len', np.uint8), ('_w_let_scores', np.float32),
+               ('_p_let_scores', np.float32))
+
+    def copy(self):
+        # independent copy, e.g. a snapshot to save while the original keeps changing
+        clone = User.__new__(User)
+        for name in self.__slots__:
+            value = getattr(self, name)
+            setattr(clone, name, value.copy() if isinstance(value, np.ndarray) else value)
+        return clone
+
+    def pack_scores(self):
+        # all score arrays as one fixed-layout blob, in _ARRAYS order
+        return b''.join(getattr(self, name).tobytes() for name, _ in self._ARRAYS)
+
+    def unpack_scores(self, blob):
+        offset = 0
+        for name, dtype in self._ARRAYS:
+            count = len(getattr(self, name))
+            setattr(self, name, np.frombuffer(blob, dtype=dtype, count=count, offset=offset).copy())
+            offset += count * np.dtype(dtype).itemsize
+
+    def __getstate__(self):
+        state = {name: getattr(self, name) for name in self.__slots__}
+        for name, dtype in self._ARRAYS:
+            state[name] = state[name].tobytes()
+        return state
+
+    def __setstate__(self, state):
+        # the default slots format is a (dict, slots) pair
+        if isinstance(state, tuple):
+            state = {**(state[0] or {}), **state[1]}
+        if '_history_bits' not in state:
+            # profiles pickled before the compact layout keep their history and scores, which are recomputed on next use
+            User.__init__(self, state['_name'], state['_proficiency'])
+            self._score_history = state.get('_score_history', [])
+            self._w_let_scores[:] = state.get('_w_let_scores', 0)
+            self._p_let_scores[:] = state.get('_p_let_scores', 0)
+            self._overall_score = float(state.get('_overall_score', 0.0))
+            return
+        self._score_params = None
+        for name in self.__slots__:
+            if name in state:
+                setattr(self, name, state[name])
+        for name, dtype in self._ARRAYS:
+            value = getattr(self, name)
+            if isinstance(value, bytes):
+                setattr(self, name, np.frombuffer(value, dtype=dtype).copy())
+
+    def display_profile(self): 
+        return ("User: ", self._name, "\nProficiency: ", self._proficiency)
+
+    def update_profile(self): # eventually not needed
+        new_name = input("Enter new profile name or * to cancel: ")
+        setattr(self, '_name', new_name) and (result:= (f"New name: {self._name}")) if new_name != '*' else (result:= ("Cancelled."))
+        return result
+    
+    def check_score(self):
+        return self._score
+
+    def update_proficiency(self):
+        if self._overall_score < MIN_LEVEL:
+            self._proficiency = "Beginner"
+        elif self._overall_score < MED_LEVEL:
+            self._proficiency = "Intermediate"
+        elif self._overall_score < MAX_LEVEL:
+            self._proficiency = "Advanced"
+        else:
+            self._proficiency = "Signed Language Sensei"
+    
+    def check_proficiency(self):
+        return self._proficiency
+
+@lru_cache(maxsize=8)
+def decay_weights(alpha=0.2, max_storage=50):
+    # weight (1-alpha) ** j of the attempt j lessons ago, computed as the original formula did
+    return tuple((1 - alpha) ** j for j in range(max_storage))
+
+def score_sums(history_bits, history_len, alpha=0.2, max_storage=50):
+    '''Computes the weighted score sums from scratch with NumPy, for any number of letters (and users)
+
+    Sums the attempts latest first with cumsum, which adds sequentially like the original formula and unlike
+    sum or a matrix product, so every history gets exactly the sums UserController.record_attempt gives it.
+
+    Args:
+        history_bits (uint64 array): packed histories, see User
+        history_len (array): number of attempts per history, same shape as history_bits
+
+    Returns:
+        scores (ndarray): weighted sum of +1/-1 results per history
+        weights (ndarray): sum of the weights per history
+    '''
+    history_bits = np.ascontiguousarray(history_bits, dtype='<u8')
+    history_len = np.asarray(history_len)
+    decay = np.array(decay_weights(alpha, max_storage))
+    # the weight sum only depends on the history length, the prefix sums add the weights in the same order
+    weight_sums = np.concatenate(([0.0], np.cumsum(decay)))
+    # column j holds the attempt j lessons ago, which has weight (1-alpha) ** j
+    results = np.unpackbits(history_bits.view(np.uint8).reshape(*history_bits.shape, 8), axis=-1,
+                            bitorder='little')[..., :max_storage]
+    present = np.arange(max_storage) < history_len[..., None]
+    # products with +1, -1 and 0 are exact, and adding 0.0 after the end of a history leaves its sum unchanged
+    scores = np.where(present, np.where(results == 1, decay, -decay), 0.0)
+    return np.cumsum(scores, axis=-1)[..., -1], weight_sums[np.minimum(history_len, max_storage)]
+
+def letter_scores(scores, weights, history_len):
+    '''Letter and overall scores from the score sums of users, as UserController stores them for a single user
+
+    Args:
+        scores, weights (ndarray): score sums, users x letters, see score_sums
+        history_len (array): number of attempts per letter, same shape
+
+    Returns:
+        w_let_scores (float32 ndarray): weighted scores from -1 to 1, 0 for letters without history
+        p_let_scores (float32 ndarray): scores from 0 to 100
+        overall_scores (float64 ndarray): average letter score of each user
+    '''
+    scored = (weights > 0) & (np.asarray(history_len) > 0)
+    w_let_scores = np.divide(scores, weights, out=np.zeros_like(scores), where=scored)
+    p_let_scores = np.where(scored, ((w_let_scores + 1) / 2) * 100, 0).astype(np.float32)
+    return w_let_scores.astype(np.float32), p_let_scores, np.mean(p_let_scores, axis=-1, dtype=np.float64)
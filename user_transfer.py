@@ -0,0 +1,35 @@
+'''File name: user_transfer.py
+Contributers: Zoe Takacs and Wyatt Shaw
+Info: Exports the user database to, or imports users from, a JSONL or CSV file, one user at a time
+Note: NOT used to run the application; e.g. python user_transfer.py export users.jsonl
+'''
+import argparse
+import logging
+import sys
+
+from controller_classes import UserController
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Bulk transfer of user profiles")
+    parser.add_argument("command", choices=("export", "import"))
+    parser.add_argument("path", help="JSONL or CSV file")
+    parser.add_argument("--db", default="user_database", help="user database name, as used by the application")
+    parser.add_argument("--backend", default="sqlite", choices=UserController.BACKENDS)
+    parser.add_argument("--format", choices=UserController.TRANSFER_FORMATS, help="taken from the file extension by default")
+    parser.add_argument("--batch-size", type=int, default=1000, help="users scored and written together on import")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    user_controller = UserController(args.db, backend=args.backend)
+    try:
+        if args.command == "export":
+            count = user_controller.export_users(args.path, args.format)
+        else:
+            count = user_controller.import_users(args.path, args.format, batch_size=args.batch_size)
+    finally:
+        user_controller.close()
+    print(f"{args.command.capitalize()}ed {count} users")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())